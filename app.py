@@ -1,8 +1,18 @@
 # app.py
 
-from flask import Flask, request, jsonify, render_template
+import atexit
+import hmac
+import io
+import os
+from xml.etree.ElementTree import ParseError
+from flask import Flask, request, jsonify, render_template, Response, stream_with_context
 from models import Base, Game, Team, TeamMember, Cylinder
 from game import GameManager
+from live import LiveHub
+from ingest import IngestQueue
+from metrics import metrics
+from rescore import ScoringPool
+from tracks import FORMATS, guess_format, parse_track, write_igc, write_gpx, write_geojson, buffered
 from flask_sqlalchemy import SQLAlchemy
 
 app = Flask(__name__)
@@ -13,7 +23,53 @@ app = Flask(__name__)
 # with app.app_context():
 #     db.create_all()
 
-manager = GameManager()#db.session)
+# Opt-in instrumentation (see metrics.py): PARACTF_METRICS=1, and
+# PARACTF_SERVER_TIMING=1 for a Server-Timing header on every response
+if os.environ.get('PARACTF_METRICS') == '1':
+    metrics.enable(os.environ.get('PARACTF_SERVER_TIMING') == '1', os.environ.get('PARACTF_PROFILE_DIR', 'profiles'))
+# /metrics and the profiles are only given to the requests bearing
+# PARACTF_METRICS_TOKEN (the server runs behind a proxy, the client address
+# tells nothing), the profiles with PARACTF_PROFILE=1 too
+METRICS_TOKEN = os.environ.get('PARACTF_METRICS_TOKEN')
+PROFILING = os.environ.get('PARACTF_PROFILE') == '1'
+
+def has_metrics_token():
+    return bool(METRICS_TOKEN) and hmac.compare_digest(request.headers.get('Authorization', '').encode(),
+                                                       ('Bearer ' + METRICS_TOKEN).encode())
+
+# Long scoring passes on PARACTF_SCORING_WORKERS processes, in the request
+# threads without it. Created first, its workers are forked before any thread.
+scoring_pool = ScoringPool(int(os.environ.get('PARACTF_SCORING_WORKERS', 0)))
+atexit.register(scoring_pool.close)
+
+manager = GameManager(scoring_pool=scoring_pool if scoring_pool.workers else None)#db.session)
+hub = LiveHub(manager)
+ingest = IngestQueue(manager)
+# store the queued positions before exiting
+atexit.register(ingest.close)
+
+# A fresh session for each request, objects loaded by a previous one are not reused
+@app.teardown_appcontext
+def remove_session(exception=None):
+    manager.Session.remove()
+    metrics.discard_request()
+
+# Per request timings when the metrics are enabled: ?timing=1 adds a
+# Server-Timing header, ?profile=1 saves a cProfile capture of the request
+# (when allowed, see above)
+@app.before_request
+def begin_request_metrics():
+    metrics.begin_request(PROFILING and request.args.get('profile') == '1' and has_metrics_token())
+
+@app.after_request
+def end_request_metrics(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    timing, profile_file = metrics.end_request(request.method, endpoint, response.status_code)
+    if timing and (metrics.server_timing or request.args.get('timing') == '1'):
+        response.headers['Server-Timing'] = timing
+    if profile_file:
+        response.headers['X-Profile'] = profile_file
+    return response
 
 # Serve static files from the 'web' directory
 app.static_folder = 'web'
@@ -89,27 +145,139 @@ def create_igame(game_id):
 # get all igames
 @app.route("/igame", methods=['GET'])
 def get_igames():
-    igames = manager.get_all_igames()
+    igames, last_positions = manager.get_all_igames_view()
     if igames:
-        return jsonify({"igames": [ g.to_json() for g in igames ], 'message': 'ok' })
+        with metrics.phase('serialize'):
+            return jsonify({"igames": [ g.to_json(last_positions) for g in igames ], 'message': 'ok' })
     else:
         return jsonify({'message': 'nok'}), 500
 
+# ETag of an igame view at a version (the status of the game changes at its end)
+def get_igame_etag(igame, version):
+    return version + ('-over' if igame.is_over() else '')
+
 @app.route('/igame/<int:igame_id>', methods=['GET'])
 def get_igame(igame_id):
-    igame = manager.find_igame_by_id(igame_id)
+    igame, last_positions = manager.find_igame_view(igame_id)
     if igame:
-        return jsonify({'igame': igame.to_json(), 'latest_score': manager.score_igame(igame.id), 'score': manager.score_igame_total(igame.id), 'message': 'ok'}), 200
+        version = hub.version(igame.id)
+        etag = get_igame_etag(igame, version)
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers={'ETag': '"%s"' % etag})
+        scores = manager.score_igame_full(igame.id)
+        with metrics.phase('serialize'):
+            response = jsonify({'igame': igame.to_json(last_positions), 'latest_score': scores['latest_score'], 'score': scores['score'], 'version': version, 'message': 'ok'})
+        response.set_etag(etag)
+        return response, 200
     else:
         return jsonify({'message': 'nok'}), 404
 
+# Flags and scores of an igame at an instant, ?at=<epoch seconds> (the
+# timeline slider of the organizers)
+@app.route('/igame/<int:igame_id>/score', methods=['GET'])
+def get_igame_score_at(igame_id):
+    at = request.args.get('at', type=float)
+    if at is None:
+        return jsonify({'message': 'nok'}), 400
+    scores = manager.score_igame_at(igame_id, at)
+    if scores is None:
+        return jsonify({'message': 'nok'}), 404
+    return jsonify(dict(scores, message='ok')), 200
+
+# Compute and save again the final results of a finished igame
+@app.route('/igame/<int:igame_id>/finalize', methods=['POST'])
+def finalize_igame(igame_id):
+    igame = manager.find_igame_by_id(igame_id)
+    if not igame:
+        return jsonify({'message': 'nok'}), 404
+    result = manager.finalize_igame(igame)
+    if result is None:
+        return jsonify({'message': 'igame not over'}), 400
+    hub.on_igame(igame.id)
+    return jsonify(dict(result.get_scores(), message='ok')), 200
+
+# Pack the fixes of a finished igame into compressed tracks (archive.py)
+@app.route('/igame/<int:igame_id>/archive', methods=['POST'])
+def archive_igame(igame_id):
+    if not manager.find_igame_by_id(igame_id):
+        return jsonify({'message': 'nok'}), 404
+    archived = manager.archive_igame(igame_id)
+    if archived is None:
+        return jsonify({'message': 'igame not over'}), 400
+    return jsonify({'archived': archived, 'message': 'ok'}), 200
+
+# Changes of an igame since the version of the client: last new position per
+# member, flags whose status changed and new scores. 'reset' means the client
+# has to reload the whole igame, 304 that nothing changed.
+@app.route('/igame/<int:igame_id>/changes', methods=['GET'])
+def get_igame_changes(igame_id):
+    igame = manager.find_igame_by_id(igame_id)
+    if not igame:
+        return jsonify({'message': 'nok'}), 404
+    since = request.args.get('since', '')
+    version, changes = hub.changes(igame.id, since)
+    etag = get_igame_etag(igame, version)
+    if (since == version and not igame.is_over()) or request.if_none_match.contains(etag):
+        return Response(status=304, headers={'ETag': '"%s"' % etag})
+    with metrics.phase('serialize'):
+        if changes is None:
+            response = jsonify({'version': version, 'reset': True, 'game_over': igame.is_over(), 'message': 'ok'})
+        else:
+            response = jsonify(dict(changes, version=version, reset=False, game_over=igame.is_over(), message='ok'))
+    response.set_etag(etag)
+    return response, 200
+
+# Live changes of an igame (Server-Sent Events): position, flags, score and reset events
+@app.route('/igame/<int:igame_id>/events', methods=['GET'])
+def get_igame_events(igame_id):
+    if not manager.find_igame_by_id(igame_id):
+        return jsonify({'message': 'nok'}), 404
+    return Response(stream_with_context(hub.stream(igame_id)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/igame/<int:igame_id>', methods=['DELETE'])
 def delete_igame(igame_id):
     if manager.delete_igame(igame_id):
+        hub.drop(igame_id)
         return jsonify({'message': 'ok'}), 200
     else:
         return jsonify({'message': 'nok'}), 500
     
+# Live fixes received, and dropped as the pilot didn't move
+@app.route('/stats/ingest', methods=['GET'])
+def get_ingest_stats():
+    return jsonify(dict(manager.get_ingest_stats(), message='ok')), 200
+
+# Score igames again from their whole history, e.g. after a fix of a scoring
+# system: {"igames": [ids], "save": true} saves the results of the finished ones
+@app.route('/rescore', methods=['POST'])
+def rescore_igames():
+    data = request.json
+    if not data or not isinstance(data.get('igames'), list):
+        return jsonify({'message': 'nok'}), 400
+    results = manager.rescore_igames(data['igames'], scoring_pool, bool(data.get('save')))
+    if data.get('save'):
+        for igame_id in results:
+            hub.on_igame(igame_id)
+    return jsonify({'scores': { igame_id: scores['score'] for igame_id, scores in results.items() }, 'message': 'ok'}), 200
+
+# Counters of the scoring cache
+@app.route('/stats/scoring', methods=['GET'])
+def get_scoring_stats():
+    return jsonify(dict(manager.get_scoring_stats(), message='ok')), 200
+
+# Prometheus metrics, when enabled and for the scrapers having the token
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not metrics.enabled or not has_metrics_token():
+        return jsonify({'message': 'nok'}), 404
+    stats = manager.get_scoring_stats()
+    extra = [ ('scoring_cache_%s' % name, 'counter', 'Scoring cache %s' % name, stats[name]) for name in ('hits', 'updates', 'misses', 'evictions') ]
+    extra.append(('scoring_cache_igames', 'gauge', 'Igames whose scoring state is kept', stats['igames']))
+    ingest_stats = manager.get_ingest_stats()
+    extra += [ ('ingest_fixes_%s' % name, 'counter', 'Live fixes %s' % name, ingest_stats[name]) for name in ('received', 'dropped') if name in ingest_stats ]
+    return Response(metrics.render(extra), mimetype='text/plain; version=0.0.4')
+
 # Create a new team
 @app.route('/igame/<int:igame_id>/team', methods=['POST'])
 def create_team(igame_id):
@@ -161,13 +329,85 @@ def add_team_member():
 @app.route('/player/<int:player_id>', methods=['PATCH'])
 def update_team_member_location(player_id):
     data = request.json
+    position = manager.parse_position(data) if isinstance(data, dict) else None
+    if position is None:
+        # checked here, the fix is stored after the response
+        return jsonify({'message': 'nok'}), 400
     member_pass = data.get('member_password')
-    latitude = data.get('latitude')
-    longitude = data.get('longitude')
-    altitude = data.get('altitude')
-    manager.update_team_member_location(player_id, member_pass, latitude, longitude, altitude)
+    latitude, longitude, altitude = position
+    if ingest.put(player_id, member_pass, latitude, longitude, altitude) is False:
+        # too many positions waiting to be stored, the client sends its next one later
+        return jsonify({'message': 'busy'}), 503, {'Retry-After': '5'}
     return jsonify({'message': f'Team member location updated successfully!'}), 200
 
+# Upload a batch of timestamped locations, e.g. after a connection loss
+@app.route('/player/<int:player_id>/locations', methods=['POST'])
+def update_team_member_locations(player_id):
+    data = request.json
+    if not data or not isinstance(data.get('locations'), list):
+        return jsonify({'message': 'nok'}), 400
+    stored = manager.update_team_member_locations(player_id, data.get('member_password'), data['locations'])
+    if stored is False:
+        return jsonify({'message': 'nok'}), 403
+    return jsonify({'stored': stored, 'rejected': len(data['locations']) - stored, 'message': 'ok'}), 200
+
+# Import the track file (IGC or GPX, ?format= or guessed) of a member sent
+# as the request body, its password in the X-Member-Password header.
+# ?replace=1 deletes the fixes stored for the member before.
+@app.route('/player/<int:player_id>/track', methods=['POST'])
+def import_player_track(player_id):
+    stream = io.BufferedReader(request.stream, 65536)
+    format = request.args.get('format') or guess_format(stream.peek(64))
+    if format not in ('igc', 'gpx'):
+        return jsonify({'message': 'unknown format'}), 400
+    member = manager.check_team_member(player_id, request.headers.get('X-Member-Password'))
+    if member is None:
+        return jsonify({'message': 'nok'}), 403
+    try:
+        fixes = parse_track(stream, format, member.team.igame.start_date)
+        result = manager.import_track(player_id, request.headers.get('X-Member-Password'), fixes, request.args.get('replace') == '1')
+    except ParseError:
+        manager.Session.rollback()
+        return jsonify({'message': 'invalid file'}), 400
+    hub.on_igame(result['igame_id'])
+    return jsonify(dict(result, message='ok')), 200
+
+# Track of a member (IGC, GPX or GeoJSON), of the members of a team or an
+# igame (GPX or GeoJSON), streamed as it is read
+def send_tracks(name, tracks):
+    format = request.args.get('format', 'gpx')
+    if format not in FORMATS or (format == 'igc' and len(tracks) != 1):
+        return jsonify({'message': 'unknown format'}), 400
+    if format == 'igc':
+        chunks = write_igc(tracks[0][0]['name'], tracks[0][1]())
+    elif format == 'gpx':
+        chunks = write_gpx(tracks)
+    else:
+        chunks = write_geojson(tracks)
+    return Response(stream_with_context(buffered(chunks)), mimetype=FORMATS[format],
+                    headers={'Content-Disposition': 'attachment; filename="%s.%s"' % (name, format)})
+
+@app.route('/player/<int:player_id>/track', methods=['GET'])
+def export_player_track(player_id):
+    tracks = manager.get_tracks(member_id=player_id)
+    if not tracks:
+        return jsonify({'message': 'nok'}), 404
+    return send_tracks('player-%d' % player_id, tracks)
+
+@app.route('/team/<int:team_id>/track', methods=['GET'])
+def export_team_tracks(team_id):
+    tracks = manager.get_tracks(team_id=team_id)
+    if not tracks:
+        return jsonify({'message': 'nok'}), 404
+    return send_tracks('team-%d' % team_id, tracks)
+
+@app.route('/igame/<int:igame_id>/track', methods=['GET'])
+def export_igame_tracks(igame_id):
+    tracks = manager.get_tracks(igame_id=igame_id)
+    if not tracks:
+        return jsonify({'message': 'nok'}), 404
+    return send_tracks('igame-%d' % igame_id, tracks)
+
 # Create a new cylinder
 @app.route('/cylinder/create', methods=['POST'])
 def create_cylinder():
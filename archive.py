@@ -0,0 +1,207 @@
+# archive.py
+# Archives the fixes of finished igames (TrackArchive) and deletes their rows:
+#   python archive.py                  every finished igame
+#   python archive.py 3 5 --vacuum     some of them, then shrink game.db
+import argparse
+import json
+import struct
+import sys
+import zlib
+from array import array
+from datetime import datetime, timedelta
+from itertools import accumulate
+from sqlalchemy import select, delete, String, type_coerce
+from models import Team, TeamMember, LocationHistory, CylinderHit, TrackArchive
+from geo import np
+
+# Blob format: magic, number of fixes, then zlib compressed: a flags byte per
+# fix (missing latitude, longitude, altitude) and five columns of int64
+# deltas: fix ids, timestamps (microseconds), latitudes and longitudes
+# (1e-7 degrees, about a centimeter) and altitudes (millimeters).
+MAGIC = b'PCT1'
+HEADER = struct.Struct('<4sI')
+DEGREE_SCALE = 10**7
+ALTITUDE_SCALE = 1000
+MISSING_LATITUDE, MISSING_LONGITUDE, MISSING_ALTITUDE = 1, 2, 4
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECONDS = timedelta(microseconds=1)
+
+# Fixes per DELETE when dropping the archived rows
+DELETE_CHUNK = 500
+
+
+def to_microseconds(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return (value - EPOCH) // MICROSECONDS
+
+# rows: (id, timestamp, latitude, longitude, altitude) of a member, in order
+def encode_track(rows):
+    flags = bytearray(len(rows))
+    columns = [ array('q') for _ in range(5) ]
+    previous = [0] * 5
+    for k, (id, timestamp, latitude, longitude, altitude) in enumerate(rows):
+        values = [ id, to_microseconds(timestamp), latitude, longitude, altitude ]
+        for c, (value, scale, flag) in enumerate(zip(values[2:], (DEGREE_SCALE, DEGREE_SCALE, ALTITUDE_SCALE),
+                                                      (MISSING_LATITUDE, MISSING_LONGITUDE, MISSING_ALTITUDE)), 2):
+            # a missing value repeats the previous one
+            if value is None:
+                flags[k] |= flag
+                values[c] = previous[c]
+            else:
+                values[c] = round(value * scale)
+        for c in range(5):
+            columns[c].append(values[c] - previous[c])
+            previous[c] = values[c]
+    if sys.byteorder != 'little':
+        for column in columns:
+            column.byteswap()
+    payload = bytes(flags) + b''.join(column.tobytes() for column in columns)
+    return HEADER.pack(MAGIC, len(rows)) + zlib.compress(payload, 9)
+
+# Seconds to add to the naive UTC seconds to get what datetime.timestamp()
+# returns (the stored datetimes are converted as local times)
+def get_local_offset(seconds):
+    return int((EPOCH + timedelta(seconds=seconds)).timestamp()) - seconds
+
+# Flags and the five integer columns of an encoded track
+def unpack_track(data):
+    magic, count = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('not a track archive')
+    payload = zlib.decompress(data[HEADER.size:])
+    flags = payload[:count]
+    if np is not None:
+        columns = np.frombuffer(payload, dtype='<i8', count=5 * count, offset=count).reshape(5, count)
+        return flags, np.cumsum(columns, axis=1)
+    columns = []
+    for c in range(5):
+        column = array('q')
+        column.frombytes(payload[count + 8 * c * count:count + 8 * (c + 1) * count])
+        if sys.byteorder != 'little':
+            column.byteswap()
+        columns.append(list(accumulate(column)))
+    return flags, columns
+
+# (ids, timestamps, latitudes, longitudes, altitudes) of an encoded track,
+# as arrays (NumPy ones when available). Timestamps are the values of
+# datetime.timestamp(), missing coordinates NaN and missing altitudes 0, as
+# in a FixStream.
+def decode_track(data):
+    flags, (ids, microseconds, latitudes, longitudes, altitudes) = unpack_track(data)
+    if np is not None:
+        seconds, fraction = np.divmod(microseconds, 10**6)
+        timestamps = get_timestamps(seconds, fraction)
+        latitudes  = latitudes / DEGREE_SCALE
+        longitudes = longitudes / DEGREE_SCALE
+        altitudes  = altitudes / ALTITUDE_SCALE
+        if any(flags):
+            flags = np.frombuffer(flags, dtype=np.uint8)
+            latitudes[(flags & MISSING_LATITUDE) != 0] = np.nan
+            longitudes[(flags & MISSING_LONGITUDE) != 0] = np.nan
+            altitudes[(flags & MISSING_ALTITUDE) != 0] = 0
+        return ids, timestamps, latitudes, longitudes, altitudes
+
+    timestamps = get_timestamps([ m // 10**6 for m in microseconds ], [ m % 10**6 for m in microseconds ])
+    latitudes  = [ float('nan') if f & MISSING_LATITUDE else v / DEGREE_SCALE for v, f in zip(latitudes, flags) ]
+    longitudes = [ float('nan') if f & MISSING_LONGITUDE else v / DEGREE_SCALE for v, f in zip(longitudes, flags) ]
+    altitudes  = [ 0 if f & MISSING_ALTITUDE else v / ALTITUDE_SCALE for v, f in zip(altitudes, flags) ]
+    return ids, timestamps, latitudes, longitudes, altitudes
+
+# datetime.timestamp() of the stored datetimes: local seconds plus the
+# microseconds, computed the same way
+def get_timestamps(seconds, fraction):
+    numpy = np is not None and isinstance(seconds, np.ndarray)
+    if not len(seconds):
+        return seconds.astype(np.float64) if numpy else []
+    offset = get_local_offset(int(seconds[0]))
+    if offset != get_local_offset(int(seconds[-1])):
+        # across a change of the local offset
+        timestamps = [ (EPOCH + timedelta(seconds=int(s), microseconds=int(f))).timestamp() for s, f in zip(seconds, fraction) ]
+        return np.array(timestamps) if numpy else timestamps
+    if numpy:
+        return (seconds + offset).astype(np.float64) + fraction / 1e6
+    return [ float(s + offset) + f / 1e6 for s, f in zip(seconds, fraction) ]
+
+
+# Archived tracks of the members of an igame: (member id, team id, decoded track)
+def load_archived_tracks(session, igame):
+    rows = session.execute(select(TrackArchive.team_member_id, Team.id, TrackArchive.data)
+                           .join(TeamMember, TrackArchive.team_member_id == TeamMember.id)
+                           .join(Team, TeamMember.team_id == Team.id)
+                           .where(Team.igame_id == igame.id)
+                           .order_by(Team.id, TrackArchive.team_member_id))
+    return [ (member_id, team_id, decode_track(data)) for member_id, team_id, data in rows ]
+
+# Stored rows of a member, in the order of the archive
+def load_member_rows(session, member_id):
+    return session.execute(select(LocationHistory.id, type_coerce(LocationHistory.timestamp, String),
+                                  LocationHistory.latitude, LocationHistory.longitude, LocationHistory.altitude)
+                           .where(LocationHistory.team_member_id == member_id)
+                           .order_by(LocationHistory.timestamp, LocationHistory.id)).all()
+
+# Rows of an archived track, to archive it again with more fixes
+def get_archived_rows(data):
+    flags, columns = unpack_track(data)
+    rows = []
+    for k, (id, microseconds, latitude, longitude, altitude) in enumerate(zip(*columns)):
+        rows.append((int(id), EPOCH + int(microseconds) * MICROSECONDS,
+                     None if flags[k] & MISSING_LATITUDE else int(latitude) / DEGREE_SCALE,
+                     None if flags[k] & MISSING_LONGITUDE else int(longitude) / DEGREE_SCALE,
+                     None if flags[k] & MISSING_ALTITUDE else int(altitude) / ALTITUDE_SCALE))
+    return rows
+
+# Latest fix of an archived track (tracks are in timestamp then id order),
+# as LocationHistory columns
+def get_last_fix(data):
+    id, timestamp, latitude, longitude, altitude = get_archived_rows(data)[-1]
+    return { 'latitude': latitude, 'longitude': longitude, 'altitude': altitude, 'timestamp': timestamp }
+
+# Pack the stored fixes of each member into its TrackArchive and
+# delete their rows (and cylinder hits), in the current transaction.
+# Returns the number of fixes archived.
+def archive_members(session, member_ids):
+    archived = 0
+    for member_id in member_ids:
+        rows = load_member_rows(session, member_id)
+        if not rows:
+            continue
+        archive = session.get(TrackArchive, member_id)
+        if archive is None:
+            archive = TrackArchive(team_member_id=member_id)
+            session.add(archive)
+            track = rows
+        else:
+            track = sorted(get_archived_rows(archive.data) + [ tuple(r) for r in rows ],
+                           key=lambda r: (to_microseconds(r[1]), r[0]))
+        archive.set_track(track, encode_track(track))
+
+        ids = [ r[0] for r in rows ]
+        for start in range(0, len(ids), DELETE_CHUNK):
+            chunk = ids[start:start+DELETE_CHUNK]
+            session.execute(delete(CylinderHit).where(CylinderHit.location_id.in_(chunk)))
+            session.execute(delete(LocationHistory).where(LocationHistory.id.in_(chunk)))
+        archived += len(rows)
+    return archived
+
+
+def main():
+    # here, game imports this module
+    from game import GameManager
+    parser = argparse.ArgumentParser(description='archive the fixes of finished igames')
+    parser.add_argument('igames', type=int, nargs='*', help='igame ids (all the finished ones by default)')
+    parser.add_argument('--db', default='sqlite:///game.db')
+    parser.add_argument('--vacuum', action='store_true', help='give the freed space back (rewrites the database)')
+    args = parser.parse_args()
+
+    manager = GameManager(args.db)
+    igames = [ g for g in manager.get_all_igames() if g.is_over() and (not args.igames or g.id in args.igames) ]
+    for igame_id in [ g.id for g in igames ]:
+        archived = manager.archive_igame(igame_id)
+        print(json.dumps({ 'igame': igame_id, 'archived': archived }))
+    if args.vacuum:
+        manager.vacuum()
+
+if __name__ == '__main__':
+    main()
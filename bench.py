@@ -0,0 +1,479 @@
+# bench.py
+# Benchmarks of the server, each result printed as a JSON line:
+#   python bench.py storage [--history N] [--writers N] [--fixes N]
+#   python bench.py ingest [--pilots N N ...] [--fixes N]
+#   python bench.py scoring [--teams N] [--pilots N] [--cylinders N] [--duration S]
+#   python bench.py archive [--teams N] [--pilots N] [--duration S]
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from sqlalchemy import insert
+from game import GameManager
+from ingest import IngestQueue
+from models import Base, Cylinder, GameInstance, LocationHistory, TeamMember
+from reference import reference_score
+from rescore import ScoringPool
+from scoring_models import ScoringFactory
+from synthetic import generate_igame, load_igame
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def latency_stats(values):
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 50) * 1000, 3) if values else None,
+        'p95_ms': round(percentile(values, 95) * 1000, 3) if values else None,
+        'max_ms': round(max(values) * 1000, 3) if values else None
+    }
+
+
+# A live igame on a fresh database: teams of pilots flying around the
+# cylinders, with history_size fixes already stored
+def setup_live_igame(manager, teams, pilots, history_size, rnd, scoring='degress'):
+    cylinders = [ Cylinder(45.0 + 0.02 * (i // 4), 6.0 + 0.02 * (i % 4), 400) for i in range(12) ]
+    game = manager.create_game('bench', cylinders)
+    igame = manager.create_igame('bench', game.id)
+    now = datetime.utcnow()
+    igame.start_date = now - timedelta(hours=2)
+    igame.end_date = now + timedelta(hours=1)
+    igame.scoring = scoring
+    manager.Session.commit()
+
+    members = []
+    for t in range(teams):
+        team = manager.create_team(igame.id, 'team %d' % t)
+        members.extend(TeamMember('pilot %d' % p, team.id) for p in range(pilots))
+    manager.Session.add_all(members)
+    manager.Session.commit()
+    manager.notify_igame(igame.id)
+
+    rows = []
+    for k in range(history_size):
+        member = members[k % len(members)]
+        c = rnd.choice(cylinders)
+        rows.append({
+            'team_member_id': member.id,
+            'latitude':  c.latitude + rnd.uniform(-0.01, 0.01),
+            'longitude': c.longitude + rnd.uniform(-0.01, 0.01),
+            'altitude':  rnd.uniform(500, 2500),
+            'timestamp': igame.start_date + timedelta(seconds=7200 * k / max(1, history_size)),
+            'classified': False
+        })
+    for start in range(0, len(rows), 5000):
+        manager.Session.execute(insert(LocationHistory), rows[start:start+5000])
+    manager.Session.commit()
+    return igame.id, [ (m.id, m.password) for m in members ]
+
+def drop_indexes(manager):
+    with manager.engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.drop(conn, checkfirst=True)
+
+# Live fixes sent one by one by the writers (one commit each, as the 5 s
+# position updates of the pilots), while the scoring polls the igame
+def run_storage_profile(profile, args):
+    rnd = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = GameManager('sqlite:///' + os.path.join(tmp, 'bench.db'), tuned_storage=(profile == 'tuned'))
+        if profile == 'legacy':
+            drop_indexes(manager)
+        igame_id, members = setup_live_igame(manager, args.teams, args.pilots, args.history, rnd, args.scoring)
+        # classify the history once, out of the measures
+        manager.score_igame_full(igame_id)
+        manager.Session.remove()
+
+        # cold scoring reads: the whole history of the igame
+        cold = []
+        for _ in range(args.repeat):
+            manager.scoring_engine.invalidate(igame_id)
+            start = time.perf_counter()
+            manager.score_igame_full(igame_id)
+            cold.append(time.perf_counter() - start)
+            manager.Session.remove()
+
+        # polls of the live scoring, nothing new to read
+        warm = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            manager.score_igame_full(igame_id)
+            warm.append(time.perf_counter() - start)
+            manager.Session.remove()
+
+        # track of a single pilot
+        member_id = members[0][0]
+        track = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            (manager.Session.query(LocationHistory)
+             .filter(LocationHistory.team_member_id == member_id)
+             .order_by(LocationHistory.timestamp).all())
+            track.append(time.perf_counter() - start)
+            manager.Session.remove()
+
+        writes = []
+        polls = []
+        errors = []
+        done = threading.Event()
+
+        def writer(w):
+            wrnd = random.Random(args.seed + w)
+            own = members[w::args.writers]
+            try:
+                for k in range(args.fixes):
+                    member_id, password = own[k % len(own)]
+                    start = time.perf_counter()
+                    try:
+                        manager.update_team_member_location(member_id, password,
+                            45.0 + wrnd.uniform(0, 0.08), 6.0 + wrnd.uniform(0, 0.08), wrnd.uniform(500, 2500))
+                    except Exception as e:
+                        manager.Session.rollback()
+                        errors.append(str(e))
+                        continue
+                    writes.append(time.perf_counter() - start)
+            finally:
+                manager.Session.remove()
+
+        def poller():
+            try:
+                while not done.is_set():
+                    start = time.perf_counter()
+                    try:
+                        manager.score_igame_full(igame_id)
+                    except Exception as e:
+                        manager.Session.rollback()
+                        errors.append(str(e))
+                        continue
+                    polls.append(time.perf_counter() - start)
+                    manager.Session.remove()
+            finally:
+                manager.Session.remove()
+
+        threads = [ threading.Thread(target=writer, args=(w,)) for w in range(args.writers) ]
+        poll_thread = threading.Thread(target=poller)
+        start = time.perf_counter()
+        poll_thread.start()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        done.set()
+        poll_thread.join()
+        manager.engine.dispose()
+
+    return {
+        'bench': 'storage',
+        'profile': profile,
+        'scoring': args.scoring,
+        'history': args.history,
+        'writers': args.writers,
+        'fixes': len(writes),
+        'errors': len(errors),
+        'ingest_fixes_per_s': round(len(writes) / elapsed, 1),
+        'ingest_latency': latency_stats(writes),
+        'poll_latency': latency_stats(polls),
+        'cold_scoring_ms': round(statistics.median(cold) * 1000, 3),
+        'warm_scoring_ms': round(statistics.median(warm) * 1000, 3),
+        'member_track_ms': round(statistics.median(track) * 1000, 3)
+    }
+
+def bench_storage(args):
+    for profile in args.profiles:
+        print(json.dumps(run_storage_profile(profile, args)), flush=True)
+
+
+
+# Latency of the position updates as seen by the pilots (one thread each,
+# sending as fast as possible), stored in the request or queued
+def run_ingest(mode, pilots, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = GameManager('sqlite:///' + os.path.join(tmp, 'bench.db'))
+        igame_id, members = setup_live_igame(manager, 4, -(-pilots // 4), 0, random.Random(args.seed))
+        members = members[:pilots]
+        manager.Session.remove()
+        ingest = IngestQueue(manager) if mode == 'queued' else None
+
+        latencies = []
+        rejected = []
+        errors = []
+        def pilot(k):
+            rnd = random.Random(args.seed + k)
+            member_id, password = members[k]
+            try:
+                for _ in range(args.fixes):
+                    lat, lon, alt = 45.0 + rnd.uniform(0, 0.08), 6.0 + rnd.uniform(0, 0.08), rnd.uniform(500, 2500)
+                    start = time.perf_counter()
+                    try:
+                        if ingest:
+                            stored = ingest.put(member_id, password, lat, lon, alt)
+                        else:
+                            stored = manager.update_team_member_location(member_id, password, lat, lon, alt)
+                    except Exception as e:
+                        manager.Session.rollback()
+                        errors.append(str(e))
+                        stored = False
+                    latencies.append(time.perf_counter() - start)
+                    if stored is False:
+                        rejected.append(k)
+                    manager.Session.remove()
+            finally:
+                manager.Session.remove()
+
+        threads = [ threading.Thread(target=pilot, args=(k,)) for k in range(pilots) ]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if ingest:
+            ingest.close()
+        elapsed = time.perf_counter() - start
+        stored = manager.Session.query(LocationHistory).count()
+        manager.Session.remove()
+        manager.engine.dispose()
+
+    stats = latency_stats(latencies)
+    stats['p99_ms'] = round(percentile(latencies, 99) * 1000, 3)
+    return {
+        'bench': 'ingest',
+        'mode': mode,
+        'pilots': pilots,
+        'sent': len(latencies),
+        'rejected': len(rejected),
+        'errors': len(errors),
+        'stored': stored,
+        'stored_per_s': round(stored / elapsed, 1),
+        'latency': stats
+    }
+
+def bench_ingest(args):
+    for pilots in args.pilots:
+        for mode in args.modes:
+            print(json.dumps(run_ingest(mode, pilots, args)), flush=True)
+
+
+
+# The scoring methods measured, each returning (counters, flags or None)
+def get_scoring_methods(manager, igame_id):
+    factory = ScoringFactory()
+    def get_igame():
+        return manager.Session.query(GameInstance).get(igame_id)
+    def engine_cold():
+        manager.scoring_engine.invalidate(igame_id)
+        scores = manager.compute_igame_scores(get_igame())
+        return scores['score'], scores['latest_score']
+    def engine_warm():
+        scores = manager.compute_igame_scores(get_igame())
+        return scores['score'], scores['latest_score']
+    def score_igame_full():
+        igame = get_igame()
+        scores = factory.get_scoring_system(igame.scoring).score_igame_full(igame)
+        return scores['score'], scores['latest_score']
+    def score_igame():
+        igame = get_igame()
+        return factory.get_scoring_system(igame.scoring).score_igame(igame), None
+    def score_latest_update():
+        igame = get_igame()
+        return None, factory.get_scoring_system(igame.scoring).score_latest_update(igame)
+    def final_results():
+        scores = manager.score_igame_full(igame_id)
+        return scores['score'], scores['latest_score']
+    return [
+        ('score_igame', score_igame),
+        ('score_latest_update', score_latest_update),
+        ('score_igame_full', score_igame_full),
+        ('engine_cold', engine_cold),
+        ('engine_warm', engine_warm),
+        ('final_results', final_results)
+    ]
+
+def measure(method, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = method()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    method()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, min(times), peak
+
+# Owner of each flag, to compare flags of the different methods
+def get_owners(flags):
+    return [ (f['cylinder_id'], f['valid_team'], f['valid_time']) for f in flags ]
+
+# Counters and flag owners are compared exactly with the reference (the igame
+# is over, all the methods score it at its end).
+def check_result(name, result, reference):
+    counters, flags = result
+    if counters is not None and { int(k): v for k, v in counters.items() } != reference[0]:
+        return False
+    if flags is not None and get_owners(flags) != get_owners(reference[1]):
+        return False
+    return True
+
+def run_scoring(storage, scoring, synthetic, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        db_url = 'sqlite://' if storage == 'memory' else 'sqlite:///' + os.path.join(tmp, 'bench.db')
+        manager = GameManager(db_url)
+        igame_id = load_igame(manager, synthetic, scoring)
+        manager.Session.remove()
+        fixes = synthetic.fix_count()
+
+        results = []
+        reference = None
+        if args.reference:
+            reference, elapsed, peak = measure(lambda: reference_score(manager.Session.query(GameInstance).get(igame_id)), 1)
+            manager.Session.remove()
+            results.append(('reference', elapsed, peak, True))
+
+        for name, method in get_scoring_methods(manager, igame_id):
+            result, elapsed, peak = measure(method, args.repeat)
+            manager.Session.remove()
+            identical = check_result(name, result, reference) if reference else None
+            results.append((name, elapsed, peak, identical))
+        manager.engine.dispose()
+
+    return [ {
+        'bench': 'scoring',
+        'storage': storage,
+        'scoring': scoring,
+        'method': name,
+        'fixes': fixes,
+        'time_s': round(elapsed, 6),
+        'fixes_per_s': round(fixes / elapsed) if elapsed else None,
+        'peak_mb': round(peak / 2**20, 3),
+        'identical': identical
+    } for name, elapsed, peak, identical in results ]
+
+def bench_scoring(args):
+    synthetic = generate_igame(args.teams, args.pilots, args.cylinders, args.fix_rate, args.duration, args.seed)
+    identical = True
+    for storage in args.storages:
+        for scoring in args.scorings:
+            for result in run_scoring(storage, scoring, synthetic, args):
+                print(json.dumps(result), flush=True)
+                identical = identical and result['identical'] is not False
+    if not identical:
+        sys.exit(1)
+
+
+# Size of the database and replay times of a finished igame, from its rows
+# then from its archived tracks. The scores must be the same.
+def bench_archive(args):
+    synthetic = generate_igame(args.teams, args.pilots, args.cylinders, args.fix_rate, args.duration, args.seed)
+    fixes = synthetic.fix_count()
+    pool = ScoringPool(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        manager = GameManager('sqlite:///' + path)
+        igame_id = load_igame(manager, synthetic, args.scoring)
+        manager.score_igame_full(igame_id)
+        manager.Session.remove()
+
+        def rescore():
+            scores = manager.rescore_igames([igame_id], pool)[igame_id]
+            return scores['score'], scores['latest_score']
+        methods = dict(get_scoring_methods(manager, igame_id), rescore=rescore)
+        results = {}
+        identical = True
+        for storage in ('rows', 'archive'):
+            if storage == 'archive':
+                start = time.perf_counter()
+                archived = manager.archive_igame(igame_id)
+                archive_s = time.perf_counter() - start
+                manager.Session.remove()
+            manager.vacuum()
+            size = os.path.getsize(path)
+            for name in ('engine_cold', 'rescore'):
+                result, elapsed, peak = measure(methods[name], args.repeat)
+                manager.Session.remove()
+                if storage == 'rows':
+                    results[name] = result
+                same = check_result(name, result, results[name])
+                identical = identical and same
+                print(json.dumps({
+                    'bench': 'archive',
+                    'storage': storage,
+                    'scoring': args.scoring,
+                    'method': name,
+                    'fixes': fixes,
+                    'db_mb': round(size / 2**20, 3),
+                    'time_s': round(elapsed, 6),
+                    'fixes_per_s': round(fixes / elapsed) if elapsed else None,
+                    'peak_mb': round(peak / 2**20, 3),
+                    'identical': same
+                }), flush=True)
+        print(json.dumps({ 'bench': 'archive', 'archived': archived, 'archive_s': round(archive_s, 3) }), flush=True)
+        manager.engine.dispose()
+    if not identical:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='paractf benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    storage = commands.add_parser('storage', help='ingest throughput and scoring queries, legacy vs tuned SQLite')
+    storage.add_argument('--profiles', nargs='+', default=['legacy', 'tuned'], choices=['legacy', 'tuned'])
+    storage.add_argument('--scoring', default='degress', choices=['trad', 'degress', 'degresslimit', 'groupmode'])
+    storage.add_argument('--history', type=int, default=50000, help='fixes stored before the measures')
+    storage.add_argument('--teams', type=int, default=4)
+    storage.add_argument('--pilots', type=int, default=5, help='pilots per team')
+    storage.add_argument('--writers', type=int, default=4, help='threads sending live fixes')
+    storage.add_argument('--fixes', type=int, default=250, help='live fixes per writer')
+    storage.add_argument('--repeat', type=int, default=5)
+    storage.add_argument('--seed', type=int, default=1)
+    storage.set_defaults(run=bench_storage)
+
+    ingest = commands.add_parser('ingest', help='position update latency, stored in the request or queued')
+    ingest.add_argument('--modes', nargs='+', default=['direct', 'queued'], choices=['direct', 'queued'])
+    ingest.add_argument('--pilots', type=int, nargs='+', default=[10, 50, 200])
+    ingest.add_argument('--fixes', type=int, default=20, help='fixes per pilot')
+    ingest.add_argument('--seed', type=int, default=1)
+    ingest.set_defaults(run=bench_ingest)
+
+    scoring = commands.add_parser('scoring', help='scoring methods on a synthetic igame, checked against the reference')
+    scoring.add_argument('--storages', nargs='+', default=['memory', 'disk'], choices=['memory', 'disk'])
+    scoring.add_argument('--scorings', nargs='+', default=['trad', 'degress', 'degresslimit', 'groupmode'], choices=['trad', 'degress', 'degresslimit', 'groupmode'])
+    scoring.add_argument('--teams', type=int, default=4)
+    scoring.add_argument('--pilots', type=int, default=5, help='pilots per team')
+    scoring.add_argument('--cylinders', type=int, default=10)
+    scoring.add_argument('--fix-rate', type=float, default=5, help='seconds between two fixes of a pilot')
+    scoring.add_argument('--duration', type=int, default=3*3600, help='seconds')
+    scoring.add_argument('--repeat', type=int, default=3)
+    scoring.add_argument('--no-reference', dest='reference', action='store_false', help="don't run (and check against) the reference")
+    scoring.add_argument('--seed', type=int, default=1)
+    scoring.set_defaults(run=bench_scoring)
+
+    archive = commands.add_parser('archive', help='database size and replay times of a finished igame, rows vs archived tracks')
+    archive.add_argument('--scoring', default='degress', choices=['trad', 'degress', 'degresslimit', 'groupmode'])
+    archive.add_argument('--teams', type=int, default=4)
+    archive.add_argument('--pilots', type=int, default=5, help='pilots per team')
+    archive.add_argument('--cylinders', type=int, default=10)
+    archive.add_argument('--fix-rate', type=float, default=5, help='seconds between two fixes of a pilot')
+    archive.add_argument('--duration', type=int, default=3*3600, help='seconds')
+    archive.add_argument('--repeat', type=int, default=3)
+    archive.add_argument('--seed', type=int, default=1)
+    archive.set_defaults(run=bench_archive)
+
+    args = parser.parse_args()
+    args.run(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+# fixstream.py
+import heapq
+from array import array
+from datetime import datetime
+from sqlalchemy import select, String, type_coerce
+from models import Team, TeamMember, LocationHistory, CylinderHit, TrackArchive
+from archive import load_archived_tracks, get_archived_rows
+from geo import CylinderSet, np
+
+# Rows fetched at a time from the cursor
+FETCH_SIZE = 5000
+
+# Chronological fixes of an igame as parallel typed arrays, instead of ORM
+# objects or a dict per fix. A missing altitude is stored as 0 (both mean
+# "no altitude" to the scoring), a missing coordinate as NaN (never in a cylinder).
+# When loaded with them, hits gives {fix index: [cylinder ids]}.
+class FixStream():
+    def __init__(self):
+        self.ids        = array('q')
+        self.timestamps = array('d')
+        self.latitudes  = array('d')
+        self.longitudes = array('d')
+        self.altitudes  = array('d')
+        self.member_ids = array('q')
+        self.team_ids   = array('q')
+        self.hits       = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, id, timestamp, latitude, longitude, altitude, member_id, team_id):
+        self.ids.append(id)
+        self.timestamps.append(timestamp)
+        self.latitudes.append(latitude if latitude is not None else float('nan'))
+        self.longitudes.append(longitude if longitude is not None else float('nan'))
+        self.altitudes.append(altitude or 0)
+        self.member_ids.append(member_id)
+        self.team_ids.append(team_id)
+
+    # Sort key of the scoring: timestamps, then teams/members/fixes in the
+    # order the igame relationships return them
+    def key(self, k):
+        return (self.timestamps[k], self.team_ids[k], self.member_ids[k], self.ids[k])
+
+    # Fixes of a member, as arrays (NumPy ones or lists)
+    def extend(self, ids, timestamps, latitudes, longitudes, altitudes, member_id, team_id):
+        if np is not None and isinstance(ids, np.ndarray):
+            self.ids.frombytes(ids.astype(np.int64).tobytes())
+            for name, values in (('timestamps', timestamps), ('latitudes', latitudes),
+                                 ('longitudes', longitudes), ('altitudes', altitudes)):
+                getattr(self, name).frombytes(np.asarray(values, dtype=np.float64).tobytes())
+        else:
+            self.ids.extend(ids)
+            self.timestamps.extend(timestamps)
+            self.latitudes.extend(latitudes)
+            self.longitudes.extend(longitudes)
+            self.altitudes.extend(altitudes)
+        self.member_ids.extend([member_id] * len(ids))
+        self.team_ids.extend([team_id] * len(ids))
+
+    def is_sorted(self):
+        return all(self.key(k - 1) <= self.key(k) for k in range(1, len(self)))
+
+    def sort(self):
+        names = ('ids', 'timestamps', 'latitudes', 'longitudes', 'altitudes', 'member_ids', 'team_ids')
+        if np is not None and len(self):
+            columns = { name: np.frombuffer(getattr(self, name), dtype=getattr(self, name).typecode) for name in names }
+            order = np.lexsort((columns['ids'], columns['member_ids'], columns['team_ids'], columns['timestamps']))
+            for name in names:
+                values = array(getattr(self, name).typecode)
+                values.frombytes(columns[name][order].tobytes())
+                setattr(self, name, values)
+            order = order.tolist()
+        else:
+            order = sorted(range(len(self)), key=self.key)
+            for name in names:
+                values = getattr(self, name)
+                setattr(self, name, array(values.typecode, (values[k] for k in order)))
+        if self.hits is not None:
+            position = { k: p for p, k in enumerate(order) }
+            self.hits = { position[k]: h for k, h in self.hits.items() }
+            self.hits = dict(sorted(self.hits.items()))
+
+    # From the location dicts of Scoring.get_all_lh_dict_sorted
+    @classmethod
+    def from_dicts(cls, locations):
+        stream = cls()
+        for k, lh in enumerate(locations):
+            stream.append(lh.get('id', k), lh['timestamp'], lh['latitude'], lh['longitude'], lh['altitude'],
+                          lh.get('member_id', 0), lh['team_id'])
+        return stream
+
+
+# Stored naive UTC datetimes, converted the same way as LocationHistory.to_json
+def to_timestamp(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value.timestamp()
+
+
+# (timestamp, latitude, longitude, altitude) fixes of a member in
+# chronological order, its stored rows streamed from the cursor (merged with
+# its archived track), for the track exports
+def iter_member_fixes(session, member_id):
+    query = (select(LocationHistory.id, type_coerce(LocationHistory.timestamp, String),
+                    LocationHistory.latitude, LocationHistory.longitude, LocationHistory.altitude)
+             .where(LocationHistory.team_member_id == member_id)
+             .order_by(LocationHistory.timestamp, LocationHistory.id))
+    rows = session.execute(query.execution_options(yield_per=FETCH_SIZE))
+    stored = ((to_datetime(r[1]), r[0], r[2], r[3], r[4]) for r in rows)
+    archive = session.get(TrackArchive, member_id)
+    if archive is not None:
+        archived = ((r[1], r[0], r[2], r[3], r[4]) for r in get_archived_rows(archive.data))
+        stored = heapq.merge(stored, archived)
+    for timestamp, id, latitude, longitude, altitude in stored:
+        yield (timestamp, latitude, longitude, altitude)
+
+def to_datetime(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+# Fixes of an igame from its start to its end, after the fix id after_id, in a single
+# query streaming the rows into a FixStream. With with_hits, only the fixes
+# inside a cylinder (see CylinderHit) are loaded, with their cylinders.
+def load_fix_stream(session, igame, after_id=0, with_hits=False):
+    # read the raw column, fromisoformat is much cheaper than the ORM datetime processing
+    columns = [ LocationHistory.id, type_coerce(LocationHistory.timestamp, String),
+                LocationHistory.latitude, LocationHistory.longitude, LocationHistory.altitude,
+                TeamMember.id, Team.id ]
+    order_by = [ LocationHistory.timestamp, Team.id, TeamMember.id, LocationHistory.id ]
+    if with_hits:
+        query = (select(*columns, CylinderHit.cylinder_id)
+                 .select_from(CylinderHit)
+                 .join(LocationHistory, CylinderHit.location_id == LocationHistory.id))
+        order_by.append(CylinderHit.cylinder_id)
+    else:
+        query = select(*columns).select_from(LocationHistory)
+    member_id = LocationHistory.team_member_id
+    if after_id:
+        # the few fixes after after_id are fewer than the whole history of
+        # the members: + 0 keeps SQLite off the member index. A full load
+        # goes through it, from the teams of the igame.
+        member_id = member_id + 0
+    query = (query
+             .join(TeamMember, member_id == TeamMember.id)
+             .join(Team, TeamMember.team_id == Team.id)
+             .where(Team.igame_id == igame.id, LocationHistory.id > after_id,
+                    LocationHistory.timestamp >= igame.start_date, LocationHistory.timestamp <= igame.end_date)
+             .order_by(*order_by))
+
+    stream = FixStream()
+    if with_hits:
+        stream.hits = {}
+    last_id = None
+    for row in session.execute(query.execution_options(yield_per=FETCH_SIZE)):
+        if row[0] != last_id:
+            stream.append(row[0], to_timestamp(row[1]), row[2], row[3], row[4], row[5], row[6])
+            last_id = row[0]
+        if with_hits:
+            stream.hits.setdefault(len(stream) - 1, []).append(row[7])
+
+    # the fixes of archived igames (archive.py) aren't rows anymore
+    tracks = load_archived_tracks(session, igame)
+    if tracks:
+        extend_archived(stream, igame, tracks, after_id)
+        stream.sort()
+    # the SQL order is the order of the stored strings, which only differs
+    # when equal instants were stored with different formats
+    elif not stream.is_sorted():
+        stream.sort()
+    return stream
+
+# Archived fixes in the same window as the stored ones. The cylinders
+# containing them are found again (their CylinderHit rows were deleted).
+def extend_archived(stream, igame, tracks, after_id):
+    start_ts = igame.start_date.timestamp()
+    end_ts = igame.end_date.timestamp()
+    cylinder_set = None
+    if stream.hits is not None:
+        cylinders = igame.game.cylinders
+        cylinder_set = CylinderSet([ (c.latitude, c.longitude, c.radius) for c in cylinders ])
+    for member_id, team_id, (ids, timestamps, latitudes, longitudes, altitudes) in tracks:
+        if np is not None and isinstance(ids, np.ndarray):
+            keep = np.nonzero((ids > after_id) & (timestamps >= start_ts) & (timestamps <= end_ts))[0]
+        else:
+            keep = [ k for k in range(len(ids)) if ids[k] > after_id and start_ts <= timestamps[k] <= end_ts ]
+        if cylinder_set is not None:
+            hits = cylinder_set.hits(take(latitudes, keep), take(longitudes, keep))
+            keep = [ keep[k] for k in sorted(hits) ]
+            found = [ sorted(cylinders[i].id for i in hits[k]) for k in sorted(hits) ]
+            if np is not None and isinstance(ids, np.ndarray):
+                keep = np.array(keep, dtype=np.int64)
+        if not len(keep):
+            continue
+        start = len(stream)
+        stream.extend(take(ids, keep), take(timestamps, keep), take(latitudes, keep), take(longitudes, keep),
+                      take(altitudes, keep), member_id, team_id)
+        if cylinder_set is not None:
+            stream.hits.update(enumerate(found, start))
+
+def take(values, indexes):
+    if np is not None and isinstance(values, np.ndarray):
+        return values[indexes]
+    return [ values[k] for k in indexes ]
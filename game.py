@@ -1,21 +1,86 @@
 # game.py
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session
-from models import Base, Game, Team, TeamMember, Cylinder, GameInstance, LocationHistory
+from sqlalchemy import select, insert, delete, update
+from sqlalchemy.orm import sessionmaker, scoped_session, selectinload, joinedload
+from models import Base, Game, Team, TeamMember, Cylinder, GameInstance, LocationHistory, CylinderHit, IgameResult, TrackArchive
 from sqlalchemy.orm import Session
-from scoring_models import ScoringFactory
+from scoring_models import ScoringFactory, ScoringJob
+from scoring_engine import IncrementalScoring
+from timeline import ScoringTimelines
+from storage import create_storage_engine, upgrade_schema
+from fixstream import load_fix_stream, iter_member_fixes
+from archive import archive_members, get_last_fix
+from ingest import FixFilter
+from roster import LiveRoster, get_digest
+from geo import CylinderSet
+from metrics import metrics
 
+import hmac
 import random
+from collections import deque
+from datetime import datetime, timedelta
+
+# Max locations in a batch upload
+MAX_BATCH_LOCATIONS = 5000
+# Rows inserted at a time when importing a track file
+IMPORT_BATCH = 5000
+# Tolerance on the clock of the phones for the timestamps of uploaded locations
+CLIENT_CLOCK_SKEW = timedelta(seconds=60)
 
 class GameManager:
-    def __init__(self, db_url='sqlite:///game.db'):
+    def __init__(self, db_url='sqlite:///game.db', tuned_storage=True, scoring_pool=None, filter_fixes=True):
         #self.session = session
-        self.engine = create_engine(db_url, pool_size=20)
+        self.engine = create_storage_engine(db_url, tuned_storage, pool_size=20)
         Base.metadata.create_all(self.engine)
+        upgrade_schema(self.engine, Base.metadata)
         self.s = sessionmaker(bind=self.engine)
         self.Session = scoped_session(self.s)
+        metrics.instrument(self.engine, self.s)
+        # long scoring passes run on the ScoringPool when given (rescore.py)
+        self.scoring_engine = IncrementalScoring(pool=scoring_pool)
+        # scoring checkpoints of the igames, for their scores at any time
+        self.timelines = ScoringTimelines(self.scoring_engine)
+        # drops the live fixes of the pilots who don't move, None to store them all
+        self.fix_filter = FixFilter() if filter_fixes else None
+        # game id -> (cylinders revision, CylinderSet, cylinder ids)
+        self.cylinder_sets = {}
+        # members of the running igames, to check the positions without reads
+        self.roster = LiveRoster(self)
+        # called with (igame id, member last position, scoring changed) after new locations are stored
+        self.location_listeners = []
+        # called with the igame id after its teams, members or game changed
+        self.igame_listeners = []
+        # called with an igame id, return its locations received but not stored yet
+        self.pending_sources = []
+        self.add_location_listener(self.scoring_engine.on_location)
+        self.add_igame_listener(self.scoring_engine.on_igame)
+        self.add_igame_listener(self.drop_result)
+        self.add_igame_listener(self.timelines.on_igame)
+        self.add_igame_listener(self.roster.on_igame)
         return
 
+    def add_location_listener(self, listener):
+        self.location_listeners.append(listener)
+
+    def notify_location(self, igame_id, position, scoring_changed):
+        for listener in self.location_listeners:
+            listener(igame_id, position, scoring_changed)
+
+    def add_igame_listener(self, listener):
+        self.igame_listeners.append(listener)
+
+    def notify_igame(self, igame_id):
+        for listener in self.igame_listeners:
+            listener(igame_id)
+
+    def add_pending_source(self, source):
+        self.pending_sources.append(source)
+
+    def get_pending_locations(self, igame_id):
+        pending = []
+        for source in self.pending_sources:
+            pending.extend(source(igame_id))
+        return pending
+
     def create_game(self, name, cylinders):
         game = Game(name=name, cylinders=cylinders)
         self.Session.add(game) #session.add(game)
@@ -31,12 +96,14 @@ class GameManager:
         team.change_color()
         self.Session.add(team)
         self.Session.commit()
+        self.notify_igame(igame_id)
         return team
 
     def update_team_color(self, team_id):
         team = self.Session.query(Team).get(team_id)
         team.change_color()
         self.Session.commit()
+        self.notify_igame(team.igame_id)
         return team
 
     def delete_team(self, igame_id, team_id):
@@ -48,6 +115,7 @@ class GameManager:
                     igame.teams.remove(t)
                     self.Session.add(igame)
                     self.Session.commit()
+                    self.notify_igame(igame_id)
                     return igame
         return False
     
@@ -55,42 +123,442 @@ class GameManager:
         member = TeamMember(name=name, team_id=team_id)
         self.Session.add(member)
         self.Session.commit()
+        self.notify_igame(member.team.igame_id)
         return member
 
     def score_igame_total(self, igame_id):
-        igame = self.Session.query(GameInstance).get(igame_id)
-        scoring_method = igame.scoring
-        factory = ScoringFactory()
-        scoring_total = factory.get_scoring_system(scoring_method).score_igame(igame)
-        return scoring_total
+        return self.score_igame_full(igame_id)['score']
+
+    # Flag statuses and team totals from the same scoring pass. Those of a
+    # finished igame are saved the first time and read from then on.
+    def score_igame_full(self, igame_id):
+        igame = self.find_igame_by_id(igame_id)
+        if igame.is_over():
+            if igame.result is None:
+                self.finalize_igame(igame)
+            if igame.result is not None:
+                return igame.result.get_scores()
+        return self.compute_igame_scores(igame)
+
+    def compute_igame_scores(self, igame):
+        scoring, state = self.scoring_engine.get_state(self.Session, igame, self.get_pending_locations(igame.id))
+        compare_ts = scoring.get_compare_ts(igame)
+        return {
+            'latest_score': scoring.get_flags(state, igame, compare_ts),
+            'score':        scoring.get_counters(state, compare_ts)
+        }
+
+    # Flag statuses and team totals at a past instant (epoch seconds), None
+    # for an unknown igame
+    def score_igame_at(self, igame_id, timestamp):
+        igame = self.find_igame_by_id(igame_id)
+        if igame is None:
+            return None
+        return self.timelines.score_at(self.Session, igame, timestamp)
+
+    # Save the final results of a finished igame, computed again from its
+    # whole history. Not before locations received before its end are all
+    # stored. Returns the IgameResult, None if the igame can't be finalized.
+    def finalize_igame(self, igame):
+        if not igame.is_over() or self.get_pending_locations(igame.id):
+            return None
+        self.scoring_engine.invalidate(igame.id)
+        return self.save_result(igame, self.compute_igame_scores(igame))
+
+    def save_result(self, igame, scores):
+        last_positions = self.get_last_positions([ m.id for t in igame.teams for m in t.members ])
+        if igame.result is None:
+            igame.result = IgameResult(igame.id, scores, last_positions)
+        else:
+            igame.result.set_scores(scores, last_positions)
+            igame.result.finalized_at = datetime.utcnow()
+        self.Session.commit()
+        # nothing will change anymore
+        self.scoring_engine.invalidate(igame.id)
+        return igame.result
+
+    # Score igames again from their whole history, the passes running on a
+    # ScoringPool (rescore.py) while the next igames are loaded (a few at a
+    # time, not to hold all their fixes). With save, the final results of the
+    # finished ones are saved again.
+    # Returns {igame id: {'latest_score', 'score'}}, unknown igames left out.
+    def rescore_igames(self, igame_ids, pool, save=False):
+        results = {}
+        passes = deque()
+        for igame_id in igame_ids:
+            igame = self.find_igame_by_id(igame_id)
+            if igame is None:
+                continue
+            scoring = ScoringFactory().get_scoring_system(igame.scoring)
+            compare_ts = scoring.get_compare_ts(igame)
+            state = scoring.new_state(igame)
+            stream = load_fix_stream(self.Session, igame)
+            passes.append((igame, scoring, state, compare_ts, pool.submit(ScoringJob(scoring, state, stream))))
+            if len(passes) > 2 * pool.workers:
+                self.end_rescore(passes.popleft(), save, results)
+        while passes:
+            self.end_rescore(passes.popleft(), save, results)
+        return results
+
+    def end_rescore(self, rescore, save, results):
+        igame, scoring, state, compare_ts, future = rescore
+        state.validations, state.counters, state.groups = future.result()
+        scores = {
+            'latest_score': scoring.get_flags(state, igame, compare_ts),
+            'score':        scoring.get_counters(state, compare_ts)
+        }
+        if save and igame.is_over() and not self.get_pending_locations(igame.id):
+            self.save_result(igame, scores)
+        results[igame.id] = scores
+
+    # Pack the fixes of a finished igame into TrackArchives and delete their
+    # rows (see archive.py). Its final results are saved first, and still
+    # computed from the archives when they are dropped later.
+    # Returns the number of fixes archived, None if the igame can't be.
+    def archive_igame(self, igame_id):
+        igame = self.find_igame_by_id(igame_id)
+        if igame is None or not igame.is_over() or self.get_pending_locations(igame.id):
+            return None
+        if igame.result is None and self.finalize_igame(igame) is None:
+            return None
+        archived = archive_members(self.Session, [ m.id for t in igame.teams for m in t.members ])
+        self.Session.commit()
+        # not notify_igame: the results are still right
+        self.scoring_engine.invalidate(igame.id)
+        self.timelines.on_igame(igame.id)
+        return archived
+
+    # Give the space freed by archive_igame back to the file system
+    def vacuum(self):
+        self.Session.remove()
+        with self.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.exec_driver_sql('VACUUM')
+            if self.engine.dialect.name == 'sqlite':
+                # the rewritten pages are in the WAL until a checkpoint
+                conn.exec_driver_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    # igame listener: the saved results don't match the teams or game anymore
+    def drop_result(self, igame_id):
+        self.Session.execute(delete(IgameResult).where(IgameResult.igame_id == igame_id))
+        self.Session.commit()
+
+    # Hits/misses of the scoring states kept between polls
+    def get_scoring_stats(self):
+        return self.scoring_engine.get_stats()
+
+    # (CylinderSet, cylinder ids) of the cylinders of a game, in the same order
+    def get_game_cylinders(self, game):
+        revision = tuple((c.id, c.latitude, c.longitude, c.radius) for c in game.cylinders)
+        cached = self.cylinder_sets.get(game.id)
+        if cached is None or cached[0] != revision:
+            cached = (revision, CylinderSet([ (c.latitude, c.longitude, c.radius) for c in game.cylinders ]),
+                      [ c.id for c in game.cylinders ])
+            self.cylinder_sets[game.id] = cached
+        return cached[1], cached[2]
+
+    # Same from the roster while the igame is loaded there (it is dropped
+    # when the cylinders change), without reading the game
+    def get_igame_cylinders(self, igame_id, game_id):
+        entry = self.roster.get_igame(igame_id)
+        if entry is not None:
+            return entry.cylinders, entry.cylinder_ids
+        return self.get_game_cylinders(self.find_game_by_id(game_id))
+
+    # Store the cylinders containing a new location next to it
+    def classify_location(self, location, cylinders, cylinder_ids):
+        location.classified = True
+        self.Session.add(location)
+        self.Session.flush()
+        hits = cylinders.contains(location.latitude, location.longitude)
+        for i in hits:
+            self.Session.add(CylinderHit(location_id=location.id, cylinder_id=cylinder_ids[i]))
+        return hits
+
+    # The cylinders of a game change: the locations of its igames have to be
+    # classified again (done by the scoring engine). In the transaction of the
+    # change, cylinders_changed is called once it is committed.
+    def reset_classification(self, game_id):
+        location_ids = (select(LocationHistory.id)
+                        .join(TeamMember, LocationHistory.team_member_id == TeamMember.id)
+                        .join(Team, TeamMember.team_id == Team.id)
+                        .join(GameInstance, Team.igame_id == GameInstance.id)
+                        .where(GameInstance.game_id == game_id))
+        self.Session.execute(delete(CylinderHit).where(CylinderHit.location_id.in_(location_ids)))
+        self.Session.execute(update(LocationHistory).where(LocationHistory.id.in_(location_ids)).values(classified=False))
+
+    # The new cylinders of a game are committed: the live positions are
+    # classified against them from now on (not before, a position received
+    # meanwhile would load the old ones again)
+    def cylinders_changed(self, game_id):
+        self.cylinder_sets.pop(game_id, None)
+        self.roster.on_game(game_id)
 
-    def score_igame(self, igame_id):
-        igame = self.Session.query(GameInstance).get(igame_id)
-        scoring_method = igame.scoring
-        factory = ScoringFactory()
-        scoring_latest = factory.get_scoring_system(scoring_method).score_latest_update(igame)
-        return scoring_latest
-        
     def update_team_member_location(self, member_id, member_pass, latitude, longitude, altitude):
-        member = self.Session.query(TeamMember).get(member_id)
+        member = self.roster.get_member(member_id, member_pass)
         if member:
-            if member.password == member_pass:
-                if member.team.igame.is_on():
-                    # Store historical location
-                    location = LocationHistory(
-                        team_member_id=member.id,
-                        latitude=latitude,
-                        longitude=longitude,
-                        altitude=altitude,
-                    )
-                    self.Session.add(location)
-                    self.Session.commit()
+            timestamp = datetime.utcnow()
+            hits = []
+            inside = len(member.igame.cylinders.contains(latitude, longitude)) > 0
+            if self.keep_fix(member.member_id, latitude, longitude, altitude, timestamp, inside):
+                # Store historical location
+                location = LocationHistory(
+                    team_member_id=member.member_id,
+                    latitude=latitude,
+                    longitude=longitude,
+                    altitude=altitude,
+                    timestamp=timestamp
+                )
+                hits = self.classify_location(location, member.igame.cylinders, member.igame.cylinder_ids)
+                self.Session.commit()
+            position = {
+                'latitude':  latitude,
+                'longitude': longitude,
+                'altitude':  altitude,
+                'timestamp': timestamp.timestamp(),
+                'member_id': member.member_id,
+                'team_id':   member.team_id
+            }
+            self.notify_location(member.igame.igame_id, position, len(hits) > 0)
         #self.update_igame(member.team.igame.id)
-                
+
+    # Where the locations of a member go, None if they can't be stored (unknown
+    # member, wrong password or igame not running). From the roster, without
+    # reading the database once the igame is loaded.
+    def get_location_target(self, member_id, member_pass):
+        member = self.roster.get_member(member_id, member_pass)
+        if member:
+            return {
+                'team_member_id': member.member_id,
+                'team_id':        member.team_id,
+                'igame_id':       member.igame.igame_id,
+                'game_id':        member.igame.game_id
+            }
+        return None
+
+    # False if a live fix doesn't have to be stored (see FixFilter)
+    def keep_fix(self, member_id, latitude, longitude, altitude, timestamp, inside):
+        return self.fix_filter is None or self.fix_filter.keep(member_id, latitude, longitude, altitude, timestamp, inside)
+
+    def get_ingest_stats(self):
+        if self.fix_filter is None:
+            return {}
+        return self.fix_filter.get_stats()
+
+    # Insert location rows with their hits of the cylinders of their game
+    # (see get_game_cylinders), in the current transaction. Returns the hits
+    # ({row index: [cylinder indexes]}), which can be given when already known.
+    def insert_locations(self, rows, cylinders, cylinder_ids, hits=None):
+        if not rows:
+            return {}
+        if hits is None:
+            hits = cylinders.hits([ r['latitude'] for r in rows ], [ r['longitude'] for r in rows ])
+        # Only the ids of the rows in a cylinder are needed: the runs of rows
+        # outside are inserted without RETURNING (a plain executemany, much
+        # cheaper), the rows keep their order and so their ids
+        ids = {}
+        start = 0
+        while start < len(rows):
+            inside = start in hits
+            end = start + 1
+            while end < len(rows) and (end in hits) == inside:
+                end += 1
+            if inside:
+                returned = self.Session.scalars(insert(LocationHistory).returning(LocationHistory.id, sort_by_parameter_order=True),
+                                                rows[start:end]).all()
+                ids.update(zip(range(start, end), returned))
+            else:
+                self.Session.execute(LocationHistory.__table__.insert(), rows[start:end])
+            start = end
+        cylinder_hits = [ { 'location_id': ids[k], 'cylinder_id': cylinder_ids[i] }
+                          for k, idx in hits.items() for i in idx ]
+        if cylinder_hits:
+            self.Session.execute(insert(CylinderHit), cylinder_hits)
+        return hits
+
+    # Store locations queued by the IngestQueue (get_location_target plus
+    # latitude, longitude, altitude and timestamp) with a single commit
+    def store_locations(self, fixes):
+        by_igame = {}
+        for f in fixes:
+            by_igame.setdefault(f['igame_id'], []).append(f)
+        changed_igames = set()
+        for igame_id, game_fixes in by_igame.items():
+            cylinders, cylinder_ids = self.get_igame_cylinders(igame_id, game_fixes[0]['game_id'])
+            hits = cylinders.hits([ f['latitude'] for f in game_fixes ], [ f['longitude'] for f in game_fixes ])
+            kept = [ k for k, f in enumerate(game_fixes)
+                     if self.keep_fix(f['team_member_id'], f['latitude'], f['longitude'], f['altitude'], f['timestamp'], k in hits) ]
+            rows = [ {
+                'team_member_id': game_fixes[k]['team_member_id'],
+                'latitude':       game_fixes[k]['latitude'],
+                'longitude':      game_fixes[k]['longitude'],
+                'altitude':       game_fixes[k]['altitude'],
+                'timestamp':      game_fixes[k]['timestamp'],
+                'classified':     True
+            } for k in kept ]
+            self.insert_locations(rows, cylinders, cylinder_ids, { n: hits[k] for n, k in enumerate(kept) if k in hits })
+            if hits:
+                changed_igames.add(igame_id)
+        self.Session.commit()
+
+        last = {}
+        for f in fixes:
+            if f['team_member_id'] not in last or last[f['team_member_id']]['timestamp'] <= f['timestamp']:
+                last[f['team_member_id']] = f
+        for f in last.values():
+            position = {
+                'latitude':  f['latitude'],
+                'longitude': f['longitude'],
+                'altitude':  f['altitude'],
+                'timestamp': f['timestamp'].timestamp(),
+                'member_id': f['team_member_id'],
+                'team_id':   f['team_id']
+            }
+            self.notify_location(f['igame_id'], position, f['igame_id'] in changed_igames)
+
+    # (latitude, longitude, altitude) of a position sent by a client, the
+    # altitude None when unknown. None if a value isn't a number.
+    def parse_position(self, data):
+        try:
+            return (float(data['latitude']), float(data['longitude']),
+                    float(data['altitude']) if data.get('altitude') is not None else None)
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    # Row for a location uploaded by a client, None if it can't be stored
+    def parse_location(self, data, igame, now):
+        position = self.parse_position(data)
+        if position is None:
+            return None
+        latitude, longitude, altitude = position
+        try:
+            # client timestamps are epoch seconds, stored as naive UTC like func.now()
+            timestamp = datetime.utcfromtimestamp(float(data['timestamp']))
+        except (KeyError, TypeError, ValueError, OverflowError, OSError):
+            return None
+        if timestamp < igame.start_date or timestamp > igame.end_date or timestamp > now + CLIENT_CLOCK_SKEW:
+            return None
+        return {
+            'latitude':   latitude,
+            'longitude':  longitude,
+            'altitude':   altitude,
+            'timestamp':  timestamp,
+            'classified': True
+        }
+
+    # Store a batch of timestamped locations of a member (e.g. the backlog of
+    # a phone that lost its connection) with a single insert and commit.
+    # Returns the number of stored locations, False if the member can't send.
+    def update_team_member_locations(self, member_id, member_pass, locations):
+        member = self.roster.get_member(member_id, member_pass)
+        if not member:
+            return False
+        igame = member.igame
+        now = datetime.utcnow()
+
+        rows = [ self.parse_location(l, igame, now) for l in locations[:MAX_BATCH_LOCATIONS] ]
+        rows = [ r for r in rows if r is not None ]
+        if not rows:
+            return 0
+        for r in rows:
+            r['team_member_id'] = member.member_id
+
+        hits = self.insert_locations(rows, igame.cylinders, igame.cylinder_ids)
+        self.Session.commit()
+
+        last = max(rows, key=lambda r: r['timestamp'])
+        position = {
+            'latitude':  last['latitude'],
+            'longitude': last['longitude'],
+            'altitude':  last['altitude'],
+            'timestamp': last['timestamp'].timestamp(),
+            'member_id': member.member_id,
+            'team_id':   member.team_id
+        }
+        self.notify_location(igame.igame_id, position, len(hits) > 0)
+        return len(rows)
+
+    # Member whose password matches, None otherwise. Not from the roster:
+    # tracks are imported once the igame is over too.
+    def check_team_member(self, member_id, member_pass):
+        member = self.Session.get(TeamMember, member_id)
+        if member is None or member_pass is None or not hmac.compare_digest(get_digest(member.password), get_digest(member_pass)):
+            return None
+        return member
+
+    # Store the fixes of a track file of a member (see tracks.py), inserted
+    # by IMPORT_BATCH rows in a single transaction, and score its igame again.
+    # Fixes outside the igame are left out. With replace, the fixes stored
+    # (or archived) for the member before are deleted.
+    # Returns {'stored', 'rejected', 'igame_id', 'score'}, None if the
+    # password doesn't match.
+    def import_track(self, member_id, member_pass, fixes, replace=False):
+        member = self.check_team_member(member_id, member_pass)
+        if member is None:
+            return None
+        igame = member.team.igame
+        cylinders = self.get_game_cylinders(igame.game)
+        latest = datetime.utcnow() + CLIENT_CLOCK_SKEW
+        if replace:
+            self.delete_member_fixes(member.id)
+
+        stored = rejected = 0
+        rows = []
+        for timestamp, latitude, longitude, altitude in fixes:
+            if timestamp < igame.start_date or timestamp > igame.end_date or timestamp > latest:
+                rejected += 1
+                continue
+            rows.append({
+                'team_member_id': member.id,
+                'latitude':       latitude,
+                'longitude':      longitude,
+                'altitude':       altitude,
+                'timestamp':      timestamp,
+                'classified':     True
+            })
+            if len(rows) >= IMPORT_BATCH:
+                self.insert_locations(rows, *cylinders)
+                stored += len(rows)
+                rows = []
+        self.insert_locations(rows, *cylinders)
+        stored += len(rows)
+        self.Session.commit()
+
+        igame_id = igame.id
+        if stored or replace:
+            # the saved results and scoring states are dropped
+            self.notify_igame(igame_id)
+        return { 'stored': stored, 'rejected': rejected, 'igame_id': igame_id, 'score': self.score_igame_total(igame_id) }
+
+    # Stored and archived fixes of a member, in the current transaction
+    def delete_member_fixes(self, member_id):
+        location_ids = select(LocationHistory.id).where(LocationHistory.team_member_id == member_id)
+        self.Session.execute(delete(CylinderHit).where(CylinderHit.location_id.in_(location_ids)))
+        self.Session.execute(delete(LocationHistory).where(LocationHistory.team_member_id == member_id))
+        self.Session.execute(delete(TrackArchive).where(TrackArchive.team_member_id == member_id))
+
+    # Tracks of the members of a team or igame (or of a member), for
+    # tracks.write_gpx/write_geojson: (properties, get_fixes), the fixes
+    # streamed from the database each time get_fixes is called
+    def get_tracks(self, member_id=None, team_id=None, igame_id=None):
+        query = (self.Session.query(TeamMember.id, TeamMember.name, Team.id, Team.name)
+                 .join(Team, TeamMember.team_id == Team.id))
+        if member_id is not None:
+            query = query.filter(TeamMember.id == member_id)
+        elif team_id is not None:
+            query = query.filter(Team.id == team_id)
+        else:
+            query = query.filter(Team.igame_id == igame_id)
+        members = query.order_by(Team.id, TeamMember.id).all()
+        return [ ({ 'name': name or 'pilot %d' % id, 'member_id': id, 'team': team_name, 'team_id': team_id },
+                  lambda id=id: iter_member_fixes(self.Session, id))
+                 for id, name, team_id, team_name in members ]
+
     def create_cylinder(self, game_id, latitude, longitude, radius):
         cylinder = Cylinder(game_id=game_id, latitude=latitude, longitude=longitude, radius=radius)
         self.Session.add(cylinder)
+        self.reset_classification(game_id)
         self.Session.commit()
+        self.cylinders_changed(game_id)
         return cylinder
     
     def find_game_by_id(self, game_id):
@@ -110,11 +578,16 @@ class GameManager:
 
             # Update the game's cylinders
             game.cylinders = new_cylinders
+            self.reset_classification(game.id)
         if 'name' in data:
             game.name = data['name']
             
         self.Session.add(game)
         self.Session.commit()
+        if 'cylinders' in data:
+            self.cylinders_changed(game.id)
+        for igame_id, in self.Session.query(GameInstance.id).filter(GameInstance.game_id == game.id):
+            self.notify_igame(igame_id)
         return game
 
     def delete_igame(self, igame_id):
@@ -122,6 +595,8 @@ class GameManager:
         if igame is not None:
             self.Session.delete(igame)
             self.Session.commit()
+            self.scoring_engine.invalidate(igame_id)
+            self.notify_igame(igame_id)
             return True
         return False
     
@@ -132,14 +607,58 @@ class GameManager:
 
         for c in game.cylinders:
             self.Session.delete(c)
+        self.reset_classification(game.id)
             
         self.Session.delete(game)
         self.Session.commit()
+        self.cylinders_changed(game_id)
         return True
 
     def find_igame_by_id(self, igame_id):
         return self.Session.query(GameInstance).get(igame_id)
 
+    # Loading options for the igame views: teams, members, game and cylinders
+    # in a query each instead of one per team/member
+    def get_igame_view_options(self):
+        return (selectinload(GameInstance.teams).selectinload(Team.members),
+                joinedload(GameInstance.game).selectinload(Game.cylinders),
+                selectinload(GameInstance.result))
+
+    # Igame with everything its to_json and its scoring need, and the last
+    # position of its members (for to_json(last_positions))
+    def find_igame_view(self, igame_id):
+        igame = (self.Session.query(GameInstance)
+                 .options(*self.get_igame_view_options())
+                 .populate_existing()
+                 .filter(GameInstance.id == igame_id)
+                 .one_or_none())
+        if igame is None:
+            return None, {}
+        if igame.result is not None:
+            return igame, igame.result.get_last_positions()
+        return igame, self.get_last_positions([ m.id for t in igame.teams for m in t.members ])
+
+    # {member id: last LocationHistory} in a single query. The last one is
+    # the latest fix (then the last stored), as uploaded backlogs arrive
+    # after newer fixes: a lookup in the member/timestamp index per member.
+    def get_last_positions(self, member_ids):
+        if not member_ids:
+            return {}
+        last_id = (select(LocationHistory.id)
+                   .where(LocationHistory.team_member_id == TeamMember.id)
+                   .order_by(LocationHistory.timestamp.desc(), LocationHistory.id.desc())
+                   .limit(1)
+                   .scalar_subquery())
+        last_ids = select(last_id).where(TeamMember.id.in_(member_ids))
+        locations = self.Session.query(LocationHistory).filter(LocationHistory.id.in_(last_ids)).all()
+        last_positions = { l.team_member_id: l for l in locations }
+        # members of archived igames, not stored in the session
+        archived = [ m for m in member_ids if m not in last_positions ]
+        if archived:
+            for member_id, data in self.Session.query(TrackArchive.team_member_id, TrackArchive.data).filter(TrackArchive.team_member_id.in_(archived)):
+                last_positions[member_id] = LocationHistory(team_member_id=member_id, **get_last_fix(data))
+        return last_positions
+
 
     def join_igame(self, igame_id, team_id, player_name):
         igame = self.find_igame_by_id(igame_id)
@@ -151,15 +670,26 @@ class GameManager:
                     player = TeamMember(name=player_name, team_id=team_id)
                     self.Session.add(player)
                     self.Session.commit()
+                    self.notify_igame(igame_id)
                     return player
         print ("error")
         return False
 
     def get_all_igames(self, active_only=False):
-        igames = self.Session.query(GameInstance).all()
+        igames = self.Session.query(GameInstance).options(*self.get_igame_view_options()).all()
 
         if not active_only:
             return igames
+
+    # All the igames and the last position of all their members
+    # (finished ones from their saved results)
+    def get_all_igames_view(self):
+        igames = self.get_all_igames()
+        last_positions = self.get_last_positions([ m.id for g in igames if g.result is None for t in g.teams for m in t.members ])
+        for g in igames:
+            if g.result is not None:
+                last_positions.update(g.result.get_last_positions())
+        return igames, last_positions
     
     def create_igame(self, name, game_id):
         game = self.find_game_by_id(game_id)
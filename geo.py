@@ -0,0 +1,163 @@
+# geo.py
+from math import radians, degrees, sin, cos, sqrt, atan2, asin, floor, isnan
+from metrics import metrics
+
+# NumPy is optional, the pure python path gives the same results
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+EARTH_RADIUS = 6371000  # meters
+
+# Fixes are tested by chunks to bound the size of the (fixes x cylinders) matrices
+CHUNK_SIZE = 4096
+
+# Size (degrees) of the grid cells used to find the candidate cylinders of a fix
+GRID_CELL = 0.05
+# Cylinders spreading over more cells are rather tested against every fix
+MAX_CELLS = 10000
+
+# Distances this close to a radius are re-checked with the scalar formula, so
+# both paths agree on fixes sitting right on a cylinder border
+BORDER_MARGIN = 1e-6
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    # Convert latitude and longitude from degrees to radians
+    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
+
+    # Haversine formula
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
+    c = 2 * atan2(sqrt(a), sqrt(1 - a))
+    distance = EARTH_RADIUS * c
+
+    return distance
+
+
+# Lat/lon box containing a whole cylinder, None when it can't be expressed
+# as one (around the poles or across the antimeridian)
+def get_bbox(latitude, longitude, radius):
+    d = degrees(radius / EARTH_RADIUS) * (1 + 1e-6) + 1e-9
+    if abs(latitude) + d >= 90:
+        return None
+    dlon = degrees(asin(min(1, sin(radians(d)) / cos(radians(latitude))))) * (1 + 1e-6) + 1e-9
+    if abs(longitude) + dlon >= 180:
+        return None
+    return (latitude - d, latitude + d, longitude - dlon, longitude + dlon)
+
+
+# The cylinders of a game, with their radians and cosines computed once, to
+# test many fixes against all of them at a time.
+# A grid of GRID_CELL cells and the bounding box of each cylinder keep the
+# haversine for the one or two cylinders a fix may actually be in.
+class CylinderSet():
+    def __init__(self, cylinders, cell=GRID_CELL):
+        # cylinders: (latitude, longitude, radius) tuples
+        self.centers = [ (c[0], c[1]) for c in cylinders ]
+        self.lat     = [ radians(c[0]) for c in cylinders ]
+        self.lon     = [ radians(c[1]) for c in cylinders ]
+        self.cos_lat = [ cos(l) for l in self.lat ]
+        self.radius  = [ c[2] for c in cylinders ]
+        self.count   = len(cylinders)
+        self.bbox    = [ get_bbox(*c) for c in cylinders ]
+
+        self.cell = cell
+        self.grid = {}
+        # cylinders without a box are candidates for every fix
+        self.everywhere = []
+        for i, box in enumerate(self.bbox):
+            rows = range(floor(box[0] / cell), floor(box[1] / cell) + 1) if box else []
+            cols = range(floor(box[2] / cell), floor(box[3] / cell) + 1) if box else []
+            if box is None or len(rows) * len(cols) > MAX_CELLS:
+                self.everywhere.append(i)
+                continue
+            for y in rows:
+                for x in cols:
+                    self.grid.setdefault((y, x), []).append(i)
+
+        if np is not None and self.count:
+            self.np_lat     = np.array(self.lat)
+            self.np_lon     = np.array(self.lon)
+            self.np_cos_lat = np.array(self.cos_lat)
+            self.np_radius  = np.array(self.radius, dtype=float)
+            self.np_bbox    = np.array([ b if b else (-np.inf, np.inf, -np.inf, np.inf) for b in self.bbox ]).T
+
+    # Indexes of the cylinders whose box contains the fix
+    def candidates(self, latitude, longitude):
+        found = self.grid.get((floor(latitude / self.cell), floor(longitude / self.cell)), [])
+        if self.everywhere:
+            found = sorted(set(found) | set(self.everywhere))
+        return [ i for i in found
+                 if self.bbox[i] is None
+                 or (self.bbox[i][0] <= latitude <= self.bbox[i][1] and self.bbox[i][2] <= longitude <= self.bbox[i][3]) ]
+
+    # Indexes of the cylinders containing a single fix
+    def contains(self, latitude, longitude):
+        if latitude is None or longitude is None or isnan(latitude) or isnan(longitude):
+            return []
+        lat1 = radians(latitude)
+        lon1 = radians(longitude)
+        cos1 = cos(lat1)
+        found = []
+        candidates = self.candidates(latitude, longitude)
+        if metrics.enabled:
+            metrics.add('cylinder_tests', len(candidates))
+        for i in candidates:
+            dlat = self.lat[i] - lat1
+            dlon = self.lon[i] - lon1
+            a = sin(dlat / 2) ** 2 + cos1 * self.cos_lat[i] * sin(dlon / 2) ** 2
+            if EARTH_RADIUS * 2 * atan2(sqrt(a), sqrt(1 - a)) <= self.radius[i]:
+                found.append(i)
+        return found
+
+    # {fix index: [cylinder indexes]} for the fixes inside at least one cylinder
+    def hits(self, lats, lons):
+        if not self.count or not len(lats):
+            return {}
+        if np is None:
+            found = {}
+            for k in range(len(lats)):
+                idx = self.contains(lats[k], lons[k])
+                if idx:
+                    found[k] = idx
+            return found
+
+        found = {}
+        for start in range(0, len(lats), CHUNK_SIZE):
+            lat = np.array(lats[start:start+CHUNK_SIZE], dtype=float)
+            lon = np.array(lons[start:start+CHUNK_SIZE], dtype=float)
+            for k, idx in self.np_hits(lat, lon).items():
+                found[start + k] = idx
+        return found
+
+    def np_hits(self, lat, lon):
+        # Box rejection first, the haversine only runs on the remaining pairs.
+        # None coordinates become NaN and never pass it.
+        box = self.np_bbox
+        lat_c = lat[:, None]
+        lon_c = lon[:, None]
+        k, i = np.nonzero((lat_c >= box[0]) & (lat_c <= box[1]) & (lon_c >= box[2]) & (lon_c <= box[3]))
+        if not len(k):
+            return {}
+        if metrics.enabled:
+            metrics.add('cylinder_tests', len(k))
+
+        lat1 = np.radians(lat[k])
+        lon1 = np.radians(lon[k])
+        dlat = self.np_lat[i] - lat1
+        dlon = self.np_lon[i] - lon1
+        a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * self.np_cos_lat[i] * np.sin(dlon / 2) ** 2
+        distance = EARTH_RADIUS * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+        radius = self.np_radius[i]
+        inside = distance <= radius
+
+        for p in np.nonzero(np.abs(distance - radius) < BORDER_MARGIN)[0]:
+            inside[p] = i[p] in self.contains(float(lat[k[p]]), float(lon[k[p]]))
+
+        found = {}
+        for p in np.nonzero(inside)[0]:
+            found.setdefault(int(k[p]), []).append(int(i[p]))
+        return found
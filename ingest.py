@@ -0,0 +1,169 @@
+# ingest.py
+import itertools
+import queue
+import threading
+import time
+from datetime import datetime
+from geo import haversine
+
+# Fixes waiting to be stored before the clients are asked to retry later
+MAX_QUEUED = 10000
+# Fixes stored per commit at most
+BATCH_SIZE = 500
+# Seconds a fix may wait for the others of its batch
+BATCH_DELAY = 0.2
+
+# A fix outside the cylinders closer than this (meters) to the last stored
+# one of its pilot, and not higher or lower by this much, is not stored...
+MIN_DISTANCE = 15
+MIN_CLIMB = 5
+# ... unless it is this late (seconds) after it
+KEEP_INTERVAL = 300
+
+# Drops the fixes of a pilot who doesn't move (on launch, in the landing
+# field: the game page sends a position every 5s anyway). Only fixes outside
+# every cylinder are dropped: the others are the only ones the scoring reads
+# and are always kept, as the first one out of a cylinder, so the scores
+# don't change. A fix is compared with the last stored one of its pilot.
+class FixFilter():
+    def __init__(self, min_distance=MIN_DISTANCE, min_climb=MIN_CLIMB, keep_interval=KEEP_INTERVAL):
+        self.min_distance = min_distance
+        self.min_climb = min_climb
+        self.keep_interval = keep_interval
+        # member id -> (latitude, longitude, altitude, timestamp, inside a cylinder) stored last
+        self.last = {}
+        self.stats = { 'received': 0, 'dropped': 0 }
+        self.lock = threading.Lock()
+
+    def has_moved(self, last, latitude, longitude, altitude, timestamp):
+        last_latitude, last_longitude, last_altitude, last_timestamp, last_inside = last
+        if last_inside or timestamp <= last_timestamp:
+            # leaving a cylinder, or older than the last stored fix
+            return True
+        if (timestamp - last_timestamp).total_seconds() >= self.keep_interval:
+            return True
+        if (altitude is None) != (last_altitude is None):
+            return True
+        if altitude is not None and abs(altitude - last_altitude) >= self.min_climb:
+            return True
+        if None in (latitude, longitude, last_latitude, last_longitude):
+            return True
+        return haversine(latitude, longitude, last_latitude, last_longitude) >= self.min_distance
+
+    # True if the fix has to be stored
+    def keep(self, member_id, latitude, longitude, altitude, timestamp, inside):
+        with self.lock:
+            self.stats['received'] += 1
+            last = self.last.get(member_id)
+            if not inside and last is not None and not self.has_moved(last, latitude, longitude, altitude, timestamp):
+                self.stats['dropped'] += 1
+                return False
+            self.last[member_id] = (latitude, longitude, altitude, timestamp, inside)
+            return True
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, stored=self.stats['received'] - self.stats['dropped'])
+
+
+# The live positions sent by the pilots are queued by the request handlers
+# and stored by a single writer thread, a batch per commit: a request doesn't
+# wait for the database, and one commit stores the fixes of many pilots.
+# Fixes queued but not stored yet are given to the scoring (pending_fixes) so
+# the scores don't lag behind the positions.
+class IngestQueue():
+    def __init__(self, manager, max_queued=MAX_QUEUED, batch_size=BATCH_SIZE, batch_delay=BATCH_DELAY):
+        self.manager = manager
+        self.queue = queue.Queue(max_queued)
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        # igame id -> {fix number: fix} of the fixes queued or being stored
+        self.pending = {}
+        self.numbers = itertools.count()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name='ingest', daemon=True)
+        self.thread.start()
+        manager.add_pending_source(self.pending_fixes)
+
+    # Queue a fix of a member. Returns None if the member can't send
+    # locations, False if the queue is full (the client should retry later).
+    def put(self, member_id, member_pass, latitude, longitude, altitude):
+        if self.closed:
+            return False
+        target = self.manager.get_location_target(member_id, member_pass)
+        if target is None:
+            return None
+        fix = dict(target, latitude=latitude, longitude=longitude, altitude=altitude,
+                   timestamp=datetime.utcnow(), number=next(self.numbers))
+        with self.lock:
+            try:
+                self.queue.put_nowait(fix)
+            except queue.Full:
+                return False
+            self.pending.setdefault(fix['igame_id'], {})[fix['number']] = fix
+        return True
+
+    def pending_fixes(self, igame_id):
+        with self.lock:
+            return list(self.pending.get(igame_id, {}).values())
+
+    # Next batch: waits for a fix, then for the others until the batch is
+    # full or the first one waited batch_delay
+    def get_batch(self):
+        try:
+            batch = [ self.queue.get(timeout=1) ]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.batch_delay
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def write(self, batch):
+        try:
+            self.store(batch)
+        finally:
+            self.manager.Session.remove()
+            with self.lock:
+                for fix in batch:
+                    fixes = self.pending.get(fix['igame_id'], {})
+                    fixes.pop(fix['number'], None)
+                    if not fixes:
+                        self.pending.pop(fix['igame_id'], None)
+            for _ in batch:
+                self.queue.task_done()
+
+    # Store a batch with a single commit, or its fixes one by one if it
+    # fails: a bad fix is logged and lost, not the others
+    def store(self, batch):
+        try:
+            self.manager.store_locations(batch)
+            return
+        except Exception as e:
+            self.manager.Session.rollback()
+            if len(batch) == 1:
+                print ("ingest failed, fix lost", batch[0], e)
+                return
+            print ("ingest failed, storing the %d fixes one by one" % len(batch), e)
+        for fix in batch:
+            self.store([ fix ])
+
+    def run(self):
+        while not (self.closed and self.queue.empty()):
+            batch = self.get_batch()
+            if batch:
+                self.write(batch)
+
+    # Wait until everything queued so far is stored
+    def flush(self):
+        self.queue.join()
+
+    # Stop taking fixes and store the queued ones (at shutdown)
+    def close(self, timeout=30):
+        self.closed = True
+        self.thread.join(timeout)
@@ -0,0 +1,268 @@
+# live.py
+import json
+import queue
+import threading
+import time
+from collections import deque
+
+# Seconds between two keep-alive comments on an idle stream
+HEARTBEAT = 15
+# Events waiting for a slow subscriber before it is asked to reload everything
+SUBSCRIBER_QUEUE = 100
+# Changes kept per igame for the clients asking for the changes since a version
+CHANGELOG_SIZE = 1000
+
+# Changes of an igame, numbered by a sequence increasing with each of them
+class ChangeLog():
+    def __init__(self):
+        self.seq = 0
+        self.changes = deque(maxlen=CHANGELOG_SIZE)
+        # last flags/score computed, to only record what changed
+        self.flags = {}
+        self.score = None
+        self.scored_at = 0
+        self.dirty = True
+        # status of the igame at the last refresh (see LiveHub.get_status)
+        self.status = None
+        self.lock = threading.Lock()
+
+    def append(self, event, data):
+        self.seq += 1
+        self.changes.append((self.seq, event, data))
+        return self.seq
+
+    # Changes after seq, merged (last position per member, last status per
+    # flag, last score). None when they are not all kept anymore.
+    def since(self, seq):
+        if seq > self.seq or (seq < self.seq and (not self.changes or self.changes[0][0] > seq + 1)):
+            return None
+        positions = {}
+        flags = {}
+        score = None
+        for s, event, data in self.changes:
+            if s <= seq:
+                continue
+            if event == 'position':
+                positions[data['member_id']] = data
+            elif event == 'flags':
+                for f in data:
+                    flags[f['cylinder_id']] = f
+            elif event == 'score':
+                score = data
+            elif event == 'reset':
+                return None
+        return { 'positions': list(positions.values()), 'flags': list(flags.values()), 'score': score }
+
+
+# Live changes of the igames. Positions are recorded as they are received.
+# Flags and scores are computed once per igame after a fix hit a cylinder (or
+# every score_interval seconds as points accrue), and only what changed is
+# recorded. The changes are then:
+# - pushed to the connected pages with Server-Sent Events (a single worker
+#   thread scores the igames having subscribers)
+# - served to the polling pages as the changes since the version they have
+class LiveHub():
+    def __init__(self, manager, score_interval=10, min_interval=1):
+        self.manager = manager
+        self.score_interval = score_interval
+        # coalesces the scoring of bursts of fixes
+        self.min_interval = min_interval
+        # versions are only comparable within the same process
+        self.epoch = int(time.time())
+        self.logs = {}
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        manager.add_location_listener(self.on_location)
+        manager.add_igame_listener(self.on_igame)
+
+    def get_log(self, igame_id):
+        with self.lock:
+            return self.logs.setdefault(igame_id, ChangeLog())
+
+    # The igame was deleted: its changes are forgotten and its streams end
+    # (a None event), it isn't scored anymore
+    def drop(self, igame_id):
+        with self.lock:
+            self.logs.pop(igame_id, None)
+            subscribers = self.subscribers.pop(igame_id, set())
+        for q in subscribers:
+            with q.mutex:
+                q.queue.clear()
+            q.put_nowait(None)
+
+    def get_version(self, seq):
+        return '%d-%d' % (self.epoch, seq)
+
+    # Sequence of a version given by a client, None if it's not from this process
+    def parse_version(self, version):
+        try:
+            epoch, seq = version.split('-')
+            if int(epoch) == self.epoch:
+                return int(seq)
+        except (AttributeError, ValueError):
+            pass
+        return None
+
+    def subscribe(self, igame_id):
+        q = queue.Queue(SUBSCRIBER_QUEUE)
+        with self.lock:
+            self.subscribers.setdefault(igame_id, set()).add(q)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='live-hub', daemon=True)
+                self.thread.start()
+        return q
+
+    def unsubscribe(self, igame_id, q):
+        with self.lock:
+            subscribers = self.subscribers.get(igame_id, set())
+            subscribers.discard(q)
+            if not subscribers:
+                self.subscribers.pop(igame_id, None)
+
+    def record(self, igame_id, event, data):
+        log = self.get_log(igame_id)
+        with log.lock:
+            seq = log.append(event, data)
+        with self.lock:
+            subscribers = list(self.subscribers.get(igame_id, ()))
+        for q in subscribers:
+            try:
+                q.put_nowait((seq, event, data))
+            except queue.Full:
+                # too late for this one, let it reload the whole igame
+                with q.mutex:
+                    q.queue.clear()
+                q.put_nowait((seq, 'reset', {}))
+
+    # GameManager location listener
+    def on_location(self, igame_id, position, scoring_changed):
+        self.record(igame_id, 'position', position)
+        if scoring_changed:
+            self.get_log(igame_id).dirty = True
+            if igame_id in self.subscribers:
+                self.wakeup.set()
+
+    # GameManager igame listener: teams, members or cylinders changed
+    def on_igame(self, igame_id):
+        self.record(igame_id, 'reset', {})
+        log = self.get_log(igame_id)
+        log.dirty = True
+        # changes are sent from scratch after a reset
+        log.flags = {}
+        log.score = None
+        if igame_id in self.subscribers:
+            self.wakeup.set()
+
+    def get_status(self, igame):
+        if igame.is_over():
+            return 'over'
+        return 'on' if igame.is_on() else 'pending'
+
+    # The igame started or ended since the last refresh: the clients reload
+    # it (its status is in the view), and the version changes with it
+    # Returns False if the igame doesn't exist anymore.
+    def check_status(self, igame_id):
+        igame = self.manager.find_igame_by_id(igame_id)
+        if igame is None:
+            return False
+        status = self.get_status(igame)
+        log = self.get_log(igame_id)
+        with log.lock:
+            previous, log.status = log.status, status
+            if previous is None or previous == status:
+                return True
+            log.dirty = True
+            log.flags = {}
+            log.score = None
+        self.record(igame_id, 'reset', {})
+        return True
+
+    # Score the igame if a fix changed something, its status changed or
+    # points accrued since the last time, and record the flags and score
+    # that changed
+    def refresh(self, igame_id):
+        if not self.check_status(igame_id):
+            # deleted, maybe by another process
+            self.drop(igame_id)
+            return
+        log = self.get_log(igame_id)
+        with log.lock:
+            if not log.dirty and time.time() - log.scored_at < self.score_interval:
+                return
+            log.dirty = False
+            log.scored_at = time.time()
+            scores = self.manager.score_igame_full(igame_id)
+
+            flags = { f['cylinder_id']: f for f in scores['latest_score'] }
+            changed = [ f for i, f in flags.items()
+                        if i not in log.flags or self.get_flag_key(f) != self.get_flag_key(log.flags[i]) ]
+            score = { team_id: round(points) for team_id, points in scores['score'].items() }
+            score_changed = score != log.score
+            log.flags = flags
+            log.score = score
+
+        if changed:
+            self.record(igame_id, 'flags', changed)
+        if score_changed:
+            self.record(igame_id, 'score', scores['score'])
+
+    def get_flag_key(self, flag):
+        return (flag['valid_team'], flag['valid_time'], round(flag.get('valid_alt') or 0))
+
+    # Current version of an igame
+    def version(self, igame_id):
+        self.refresh(igame_id)
+        return self.get_version(self.get_log(igame_id).seq)
+
+    # (version, changes since the given version), changes being None when the
+    # client must reload the whole igame
+    def changes(self, igame_id, since):
+        self.refresh(igame_id)
+        log = self.get_log(igame_id)
+        seq = self.parse_version(since)
+        with log.lock:
+            current = log.seq
+            changes = log.since(seq) if seq is not None else None
+        return self.get_version(current), changes
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.score_interval)
+            self.wakeup.clear()
+            with self.lock:
+                igame_ids = list(self.subscribers)
+                if not igame_ids:
+                    # started again by the next subscriber
+                    self.thread = None
+                    return
+            for igame_id in igame_ids:
+                try:
+                    self.refresh(igame_id)
+                except Exception as e:
+                    print ("live scoring failed", igame_id, e)
+                    self.record(igame_id, 'reset', {})
+            # fresh session (and data) for the next round
+            self.manager.Session.remove()
+            time.sleep(self.min_interval)
+
+    # Server-Sent Events stream of an igame, the event ids being the versions
+    def stream(self, igame_id):
+        q = self.subscribe(igame_id)
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    item = q.get(timeout=HEARTBEAT)
+                except queue.Empty:
+                    yield ': ping\n\n'
+                    continue
+                if item is None:
+                    # igame deleted: the client must not reconnect
+                    yield 'event: deleted\ndata: {}\n\n'
+                    return
+                seq, event, data = item
+                yield 'id: %s\nevent: %s\ndata: %s\n\n' % (self.get_version(seq), event, json.dumps(data))
+        finally:
+            self.unsubscribe(igame_id, q)
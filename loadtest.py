@@ -0,0 +1,236 @@
+# loadtest.py
+# HTTP load test of the live game endpoints, against a local server only:
+#   python loadtest.py --serve                       (throwaway server and database)
+#   python loadtest.py --url http://127.0.0.1:5000   (server already running)
+# Pilots replay synthetic tracks with PATCH /player/<id> and spectators poll
+# GET /igame/<id>, as play.html does. Results are printed as JSON lines, one
+# per endpoint and a summary.
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from urllib.parse import urlparse
+from bench import percentile
+from synthetic import generate_igame
+
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1')
+
+
+# Requests of an endpoint
+class EndpointStats():
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        # requests sent more than an interval after their planned time
+        self.late = 0
+        self.lock = threading.Lock()
+
+    def add(self, latency, status, error, late):
+        with self.lock:
+            self.latencies.append(latency)
+            self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+            self.errors += error
+            self.late += late
+
+    def to_json(self, elapsed):
+        ms = lambda v: round(v * 1000, 3) if v is not None else None
+        return {
+            'endpoint': self.name,
+            'requests': len(self.latencies),
+            'throughput_per_s': round(len(self.latencies) / elapsed, 2),
+            'errors': self.errors,
+            'error_rate': round(self.errors / len(self.latencies), 4) if self.latencies else None,
+            'late': self.late,
+            'statuses': self.statuses,
+            'p50_ms': ms(percentile(self.latencies, 50)),
+            'p90_ms': ms(percentile(self.latencies, 90)),
+            'p99_ms': ms(percentile(self.latencies, 99)),
+            'max_ms': ms(max(self.latencies) if self.latencies else None)
+        }
+
+
+class LoadTest():
+    def __init__(self, args):
+        self.args = args
+        self.url = args.url.rstrip('/')
+        self.stats = {}
+        self.stop = threading.Event()
+
+    def request(self, method, path, data=None, headers=None, timeout=30):
+        body = json.dumps(data).encode() if data is not None else None
+        request = urllib.request.Request(self.url + path, data=body, method=method, headers=dict(headers or {}))
+        if body is not None:
+            request.add_header('Content-Type', 'application/json')
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                return response.status, response.read(), response.headers
+        except urllib.error.HTTPError as e:
+            return e.code, e.read(), e.headers
+
+    def call(self, name, method, path, data=None, headers=None, late=False):
+        stats = self.stats.setdefault(name, EndpointStats(name))
+        start = time.perf_counter()
+        try:
+            status, body, response_headers = self.request(method, path, data, headers)
+        except Exception as e:
+            stats.add(time.perf_counter() - start, type(e).__name__, 1, late)
+            return None, None, None
+        stats.add(time.perf_counter() - start, status, int(status >= 400), late)
+        return status, body, response_headers
+
+    # Game, igame, teams and members created through the API
+    def setup(self, synthetic):
+        cylinders = [ { 'latitude': lat, 'longitude': lon, 'radius': radius } for lat, lon, radius in synthetic.cylinders ]
+        status, body, _ = self.request('POST', '/game', { 'name': 'loadtest', 'cylinders': cylinders })
+        game_id = json.loads(body)['game']['id']
+        status, body, _ = self.request('POST', '/igame/%d' % game_id, { 'name': 'loadtest' })
+        igame_id = json.loads(body)['igame']['id']
+        for t in range(len(synthetic.teams)):
+            self.request('POST', '/igame/%d/team' % igame_id, { 'name': 'team %d' % t })
+        status, body, _ = self.request('GET', '/igame/%d' % igame_id)
+        team_ids = [ t['id'] for t in json.loads(body)['igame']['teams'] ]
+
+        pilots = []
+        for t, tracks in enumerate(synthetic.teams):
+            for p, track in enumerate(tracks):
+                status, body, _ = self.request('POST', '/igame/%d/team/%d' % (igame_id, team_ids[t]), { 'player_name': 'pilot %d' % p })
+                player = json.loads(body)['player']
+                pilots.append((player['id'], player['password'], track))
+        return igame_id, pilots[:self.args.pilots]
+
+    # Sleep until the planned time, True if it's already late by more than interval
+    def wait(self, planned, interval):
+        delay = planned - time.monotonic()
+        if delay > 0:
+            self.stop.wait(delay)
+        return -delay > interval
+
+    def pilot(self, member_id, password, track, start):
+        interval = self.args.pilot_interval
+        planned = start + random.uniform(0, interval)
+        for _, lat, lon, altitude in track:
+            late = self.wait(planned, interval)
+            if self.stop.is_set():
+                return
+            self.call('PATCH /player/<id>', 'PATCH', '/player/%d' % member_id,
+                      { 'member_password': password, 'latitude': lat, 'longitude': lon, 'altitude': altitude }, late=late)
+            planned += interval
+
+    def spectator(self, igame_id, start):
+        interval = self.args.spectator_interval
+        planned = start + random.uniform(0, interval)
+        version = None
+        while True:
+            late = self.wait(planned, interval)
+            if self.stop.is_set():
+                return
+            if self.args.spectators_mode == 'changes' and version:
+                status, body, _ = self.call('GET /igame/<id>/changes', 'GET', '/igame/%d/changes?since=%s' % (igame_id, version), late=late)
+                if status == 200:
+                    data = json.loads(body)
+                    version = None if data.get('reset') else data.get('version')
+            else:
+                status, body, _ = self.call('GET /igame/<id>', 'GET', '/igame/%d' % igame_id, late=late)
+                if status == 200:
+                    version = json.loads(body).get('version')
+            planned += interval
+
+    def run(self):
+        args = self.args
+        teams = min(args.teams, args.pilots)
+        synthetic = generate_igame(teams, -(-args.pilots // teams), args.cylinders, args.pilot_interval,
+                                   args.duration + args.pilot_interval, args.seed)
+        igame_id, pilots = self.setup(synthetic)
+
+        start = time.monotonic() + 1
+        threads = [ threading.Thread(target=self.pilot, args=(member_id, password, track, start), daemon=True)
+                    for member_id, password, track in pilots ]
+        threads += [ threading.Thread(target=self.spectator, args=(igame_id, start), daemon=True)
+                     for _ in range(args.spectators) ]
+        for t in threads:
+            t.start()
+        self.stop.wait(args.duration + 1)
+        self.stop.set()
+        elapsed = time.monotonic() - start
+        for t in threads:
+            t.join(30)
+
+        results = [ dict(loadtest='endpoint', **stats.to_json(elapsed)) for stats in self.stats.values() ]
+        requests = sum(r['requests'] for r in results)
+        errors = sum(r['errors'] for r in results)
+        results.append({
+            'loadtest': 'summary',
+            'pilots': len(pilots),
+            'spectators': args.spectators,
+            'duration_s': round(elapsed, 1),
+            'requests': requests,
+            'throughput_per_s': round(requests / elapsed, 2),
+            'errors': errors,
+            'error_rate': round(errors / requests, 4) if requests else None
+        })
+        return results
+
+
+def wait_for_server(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url + '/game', timeout=1).read()
+            return True
+        except Exception:
+            time.sleep(0.2)
+    return False
+
+# The app in another process (not to share the interpreter with the load),
+# with a database in a temporary directory
+def start_server(port, tmp):
+    code = 'import app; app.app.run(host="127.0.0.1", port=%d, threaded=True)' % port
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    return subprocess.Popen([ sys.executable, '-c', code ], cwd=tmp, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def main():
+    parser = argparse.ArgumentParser(description='paractf HTTP load test (local server only)')
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--serve', action='store_true', help='start a throwaway server on the port of --url')
+    parser.add_argument('--pilots', type=int, default=100)
+    parser.add_argument('--pilot-interval', type=float, default=5, help='seconds between two positions of a pilot')
+    parser.add_argument('--spectators', type=int, default=300)
+    parser.add_argument('--spectator-interval', type=float, default=10, help='seconds between two polls of a spectator')
+    parser.add_argument('--spectators-mode', default='igame', choices=['igame', 'changes'],
+                        help='poll the whole igame, or the changes since the last version')
+    parser.add_argument('--teams', type=int, default=4)
+    parser.add_argument('--cylinders', type=int, default=10)
+    parser.add_argument('--duration', type=int, default=60, help='seconds')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    url = urlparse(args.url)
+    if url.hostname not in LOCAL_HOSTS:
+        parser.error('only local servers can be load tested')
+
+    server = None
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.serve:
+            server = start_server(url.port or 80, tmp)
+        try:
+            if not wait_for_server(args.url.rstrip('/')):
+                parser.error('no server answering on %s' % args.url)
+            for result in LoadTest(args).run():
+                print(json.dumps(result), flush=True)
+        finally:
+            if server:
+                server.terminate()
+                server.wait()
+
+if __name__ == '__main__':
+    main()
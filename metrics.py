@@ -0,0 +1,188 @@
+# metrics.py
+import cProfile
+import os
+import threading
+import time
+from contextlib import contextmanager
+from sqlalchemy import event
+
+# Exposed metrics: name -> (type, help). Counters get their _total suffix in
+# the Prometheus output.
+METRICS = {
+    'requests':              ('counter', 'Requests served'),
+    'request_seconds':       ('counter', 'Time spent serving requests'),
+    'request_phase_seconds': ('counter', 'Time spent per phase of the requests (phases overlap: sql runs inside scoring)'),
+    'request_sql_queries':   ('counter', 'SQL queries run by the requests'),
+    'sql_queries':           ('counter', 'SQL queries run'),
+    'sql_seconds':           ('counter', 'Time spent in SQL queries'),
+    'orm_lazy_loads':        ('counter', 'Relationships loaded lazily by the ORM'),
+    'scoring_runs':          ('counter', 'Scores computed'),
+    'scoring_seconds':       ('counter', 'Time spent computing scores'),
+    'scoring_fixes':         ('counter', 'Fixes consumed by the scoring'),
+    'cylinder_tests':        ('counter', 'Distances from a fix to a cylinder computed'),
+    'serialize_seconds':     ('counter', 'Time spent serializing responses'),
+}
+
+# Phases reported in the Server-Timing header, in this order
+TIMING_PHASES = ('sql', 'scoring', 'serialize')
+
+
+# Phases and counts of the request being served by a thread
+class RequestMetrics():
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.queries = 0
+        self.profile = None
+
+
+# Opt-in instrumentation of the hot paths: SQL queries (engine events), ORM
+# lazy loads, scoring, cylinder tests and serialization, totalled per
+# request. Nothing is recorded while disabled, the instrumented code only
+# checks metrics.enabled.
+class Metrics():
+    def __init__(self):
+        self.enabled = False
+        # Server-Timing header on every response, not only on ?timing=1
+        self.server_timing = False
+        self.profile_dir = 'profiles'
+        # (name, labels) -> value
+        self.values = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # a single cProfile capture at a time
+        self.profile_lock = threading.Lock()
+
+    def enable(self, server_timing=False, profile_dir='profiles'):
+        self.enabled = True
+        self.server_timing = server_timing
+        self.profile_dir = profile_dir
+
+    def add(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def current(self):
+        return getattr(self.local, 'request', None)
+
+    @contextmanager
+    def phase(self, name, **labels):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.add(name + '_seconds', elapsed, **labels)
+            request = self.current()
+            if request is not None:
+                request.phases[name] = request.phases.get(name, 0) + elapsed
+
+    # SQL queries of the engine and lazy loads of its sessions
+    def instrument(self, engine, sessionmaker):
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if self.enabled:
+                conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if not self.enabled or not conn.info.get('metrics_start'):
+                return
+            elapsed = time.perf_counter() - conn.info['metrics_start'].pop()
+            self.add('sql_queries')
+            self.add('sql_seconds', elapsed)
+            request = self.current()
+            if request is not None:
+                request.queries += 1
+                request.phases['sql'] = request.phases.get('sql', 0) + elapsed
+
+        @event.listens_for(sessionmaker, 'do_orm_execute')
+        def do_orm_execute(orm_execute_state):
+            if self.enabled and orm_execute_state.is_select and orm_execute_state.lazy_loaded_from is not None:
+                self.add('orm_lazy_loads')
+
+    def begin_request(self, profile=False):
+        if not self.enabled:
+            return
+        request = RequestMetrics()
+        if profile and self.profile_lock.acquire(blocking=False):
+            request.profile = cProfile.Profile()
+            request.profile.enable()
+        self.local.request = request
+
+    # Request that failed before end_request: its capture is dropped
+    def discard_request(self):
+        request = self.current()
+        if request is None:
+            return
+        self.local.request = None
+        if request.profile is not None:
+            request.profile.disable()
+            self.profile_lock.release()
+
+    # Totals of the request. Returns the Server-Timing header value and the
+    # file of the cProfile capture (None when not captured).
+    def end_request(self, method, endpoint, status):
+        request = self.current()
+        if request is None:
+            return None, None
+        self.local.request = None
+        elapsed = time.perf_counter() - request.start
+
+        profile_file = None
+        if request.profile is not None:
+            request.profile.disable()
+            os.makedirs(self.profile_dir, exist_ok=True)
+            name = '%s%s' % (method, endpoint.replace('/', '_').replace('<', '').replace('>', '').replace(':', '-'))
+            profile_file = os.path.join(self.profile_dir, '%d-%s.prof' % (time.time() * 1000, name))
+            request.profile.dump_stats(profile_file)
+            self.profile_lock.release()
+            print ("profile of %s %s saved to %s" % (method, endpoint, profile_file))
+
+        self.add('requests', method=method, endpoint=endpoint, status=str(status))
+        self.add('request_seconds', elapsed, method=method, endpoint=endpoint)
+        self.add('request_sql_queries', request.queries, method=method, endpoint=endpoint)
+        for phase, seconds in request.phases.items():
+            self.add('request_phase_seconds', seconds, method=method, endpoint=endpoint, phase=phase)
+
+        timing = [ '%s;dur=%.3f' % (phase, request.phases[phase] * 1000) for phase in TIMING_PHASES if phase in request.phases ]
+        timing.append('total;dur=%.3f;desc="%d queries"' % (elapsed * 1000, request.queries))
+        return ', '.join(timing), profile_file
+
+    # Prometheus text format, with extra (name, type, help, value) samples
+    def render(self, extra=()):
+        with self.lock:
+            values = dict(self.values)
+        lines = []
+        for name, (kind, help) in METRICS.items():
+            samples = sorted((labels, value) for (n, labels), value in values.items() if n == name)
+            if not samples:
+                continue
+            metric = 'paractf_%s%s' % (name, '_total' if kind == 'counter' else '')
+            lines.append('# HELP %s %s' % (metric, help))
+            lines.append('# TYPE %s %s' % (metric, kind))
+            for labels, value in samples:
+                lines.append('%s%s %s' % (metric, format_labels(labels), format_value(value)))
+        for name, kind, help, value in extra:
+            metric = 'paractf_%s%s' % (name, '_total' if kind == 'counter' else '')
+            lines.append('# HELP %s %s' % (metric, help))
+            lines.append('# TYPE %s %s' % (metric, kind))
+            lines.append('%s %s' % (metric, format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{%s}' % ','.join('%s="%s"' % (k, escape(v)) for k, v in labels)
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+metrics = Metrics()
@@ -1,9 +1,10 @@
 # models.py
 
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime, Boolean, Index, Text, LargeBinary, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
+import json
 import time
 import string
 import random
@@ -41,6 +42,7 @@ class GameInstance(Base):
     teams = relationship('Team', back_populates='igame')
     game  = relationship('Game')
     scoring = Column(String)
+    result = relationship('IgameResult', uselist=False, cascade='all, delete-orphan')
 
     def __init__(self, name, game_id):
         self.name = name
@@ -57,7 +59,9 @@ class GameInstance(Base):
     def is_over(self):
         return datetime.utcnow() > self.end_date
     
-    def to_json(self):
+    # last_positions: {member id: LocationHistory} loaded beforehand, see
+    # GameManager.get_last_positions, instead of each member's history
+    def to_json(self, last_positions=None):
         status = "<fontcolor='orange'>Not started!</font>"
         if datetime.utcnow() > self.start_date:
             status = "<font color='green'>Game is on!</font>"
@@ -70,7 +74,7 @@ class GameInstance(Base):
             'game_id': self.game_id,
             'start_date': self.start_date.timestamp(),
             'end_date': self.end_date.timestamp(),
-            'teams': [ t.to_json() for t in self.teams ],
+            'teams': [ t.to_json(last_positions) for t in self.teams ],
             'cylinders': [ c.to_json() for c in self.game.cylinders ],
             'status': status,
             'game_over': self.is_over()
@@ -81,15 +85,15 @@ class Team(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String)
     color   = Column(Integer)
-    igame_id = Column(Integer, ForeignKey('gameinstances.id'))
+    igame_id = Column(Integer, ForeignKey('gameinstances.id'), index=True)
     igame = relationship('GameInstance', back_populates='teams')
     members = relationship('TeamMember', back_populates='team')
 
-    def to_json(self):
+    def to_json(self, last_positions=None):
         return {
             'name': self.name,
             'id':   self.id,
-            'members': [ m.to_json() for m in self.members ],
+            'members': [ m.to_json(last_positions=last_positions) for m in self.members ],
             'color':  self.get_color_hex()
         }
 
@@ -108,7 +112,7 @@ class TeamMember(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String)
     password = Column(String)
-    team_id = Column(Integer, ForeignKey('teams.id'))
+    team_id = Column(Integer, ForeignKey('teams.id'), index=True)
     team = relationship('Team', back_populates='members')
     location_history = relationship('LocationHistory', back_populates='member')
 
@@ -121,16 +125,24 @@ class TeamMember(Base):
         letters = string.ascii_lowercase
         return ''.join(random.choice(letters) for i in range(length))
         
-    def to_json(self, with_pass=False):
+    def to_json(self, with_pass=False, last_positions=None):
+        if last_positions is not None:
+            last_position = last_positions.get(self.id)
+        else:
+            last_position = self.location_history[-1] if self.location_history and len(self.location_history) > 0 else None
         return {
             'id': self.id,
             'name': self.name,
             'password': self.password if with_pass else None,
-            'last_position': self.location_history[-1].to_json() if self.location_history and len(self.location_history) > 0 else None
+            'last_position': last_position.to_json() if last_position else None
         }
 
 class LocationHistory(Base):
     __tablename__ = 'locationhistory'
+    # the fixes are read per member (or igame) in chronological order, the
+    # scoring engine looks for the few ones left to classify
+    __table_args__ = (Index('ix_locationhistory_member_timestamp', 'team_member_id', 'timestamp'),
+                      Index('ix_locationhistory_unclassified', 'team_member_id', sqlite_where=text('classified IS NOT 1')))
     id = Column(Integer, primary_key=True)
     team_member_id = Column(Integer, ForeignKey('teammembers.id'))
     member = relationship('TeamMember', back_populates='location_history')
@@ -138,6 +150,9 @@ class LocationHistory(Base):
     longitude = Column(Float)
     altitude = Column(Float)
     timestamp = Column(DateTime(timezone=False), server_default=func.now())
+    # set once the location has been tested against the game cylinders, its
+    # CylinderHit rows are then up to date
+    classified = Column(Boolean)
 
     def to_json(self):
         return {
@@ -147,6 +162,67 @@ class LocationHistory(Base):
             'timestamp': self.timestamp.timestamp()
         }
 
+# A location inside a game cylinder, computed when the location is received.
+# Scoring only reads these and skips the locations in between flags.
+class CylinderHit(Base):
+    __tablename__ = 'cylinderhits'
+    location_id = Column(Integer, ForeignKey('locationhistory.id'), primary_key=True)
+    cylinder_id = Column(Integer, ForeignKey('cylinders.id'), primary_key=True)
+
+# Final flags and scores of a finished igame, and the last positions of its
+# members, saved the first time it is scored after its end (see
+# GameManager.finalize_igame) and served from then on
+class IgameResult(Base):
+    __tablename__ = 'igameresults'
+    igame_id = Column(Integer, ForeignKey('gameinstances.id'), primary_key=True)
+    flags = Column(Text)
+    score = Column(Text)
+    last_positions = Column(Text)
+    finalized_at = Column(DateTime(timezone=False), server_default=func.now())
+
+    def __init__(self, igame_id, scores, last_positions):
+        self.igame_id = igame_id
+        self.set_scores(scores, last_positions)
+
+    def set_scores(self, scores, last_positions):
+        self.flags = json.dumps(scores['latest_score'])
+        self.score = json.dumps(scores['score'])
+        self.last_positions = json.dumps({ member_id: l.to_json() for member_id, l in last_positions.items() })
+
+    # as returned by GameManager.score_igame_full (JSON keys are strings)
+    def get_scores(self):
+        return {
+            'latest_score': json.loads(self.flags),
+            'score':        { int(team_id): points for team_id, points in json.loads(self.score).items() }
+        }
+
+    # {member id: LocationHistory} for the to_json methods, not stored in the session
+    def get_last_positions(self):
+        return { int(member_id): LocationHistory(latitude=l['latitude'], longitude=l['longitude'], altitude=l['altitude'],
+                                                 timestamp=datetime.fromtimestamp(l['timestamp']))
+                 for member_id, l in json.loads(self.last_positions).items() }
+
+# The fixes of a member of a finished igame, packed by archive.py once the
+# igame is archived (its LocationHistory and CylinderHit rows are deleted).
+# load_fix_stream reads them with the stored ones.
+class TrackArchive(Base):
+    __tablename__ = 'trackarchives'
+    team_member_id = Column(Integer, ForeignKey('teammembers.id'), primary_key=True)
+    fix_count = Column(Integer)
+    first_timestamp = Column(DateTime(timezone=False))
+    last_timestamp  = Column(DateTime(timezone=False))
+    data = Column(LargeBinary)
+    archived_at = Column(DateTime(timezone=False), server_default=func.now())
+
+    # track: (id, timestamp, latitude, longitude, altitude) rows, data: their encoding
+    def set_track(self, track, data):
+        to_datetime = lambda t: datetime.fromisoformat(t) if isinstance(t, str) else t
+        self.fix_count = len(track)
+        self.first_timestamp = to_datetime(track[0][1])
+        self.last_timestamp  = to_datetime(track[-1][1])
+        self.data = data
+        self.archived_at = datetime.utcnow()
+
 class Cylinder(Base):
     __tablename__ = 'cylinders'
     id = Column(Integer, primary_key=True)
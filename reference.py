@@ -0,0 +1,162 @@
+# reference.py
+from datetime import datetime
+from geo import haversine
+
+# Straightforward implementations of the current scoring rules: every
+# location of the igame loaded through the ORM and replayed from the start,
+# tested against every cylinder. Slow but simple, they are the reference the
+# optimized engines are checked against (bench.py scoring).
+class ReferenceScoring():
+    def get_game_cylinders(self, igame):
+        return [ {
+            "cylinder_id": c.id,
+            "lat": c.latitude,
+            "lon": c.longitude,
+            "radius": c.radius,
+            "valid_time": 0,
+            "valid_color": None,
+            "valid_team": None,
+            "altitude": 0
+        } for c in igame.game.cylinders ]
+
+    def is_location_in_cylinder(self, lh, v):
+        return haversine(lh['latitude'], lh['longitude'], v['lat'], v['lon']) <= v['radius'] and v['valid_time'] < int(lh['timestamp'])
+
+    def get_zero_counters(self, igame):
+        return { team.id: 0 for team in igame.teams }
+
+    def get_all_lh_dict_sorted(self, igame):
+        all_locations = []
+        for t in igame.teams:
+            for m in t.members:
+                for lh in m.location_history:
+                    if lh.timestamp < igame.start_date:
+                        continue
+                    all_locations.append( {
+                        'team_name': t.name,
+                        'team_id':   t.id,
+                        'member_id': m.id,
+                        'timestamp': lh.timestamp.timestamp(),
+                        'latitude':  lh.latitude,
+                        'longitude': lh.longitude,
+                        'altitude':  lh.altitude
+                    })
+        return sorted(all_locations, key=lambda x: x['timestamp'])
+
+    def get_compare_ts(self, igame):
+        return min(datetime.utcnow(), igame.end_date).timestamp()
+
+    # Counters of the validations still held at compare_ts added
+    def add_held(self, counters, validations, compare_ts):
+        for v in validations:
+            if v['valid_team']:
+                counters[v['valid_team']] += compare_ts - v['valid_time']
+        return counters
+
+class ReferenceTraditional(ReferenceScoring):
+    def score_igame(self, igame):
+        counters = self.get_zero_counters(igame)
+        validations = self.get_game_cylinders(igame)
+        for lh in self.get_all_lh_dict_sorted(igame):
+            if lh['timestamp'] > igame.end_date.timestamp():
+                break
+            for v in validations:
+                if not lh['altitude']:
+                    continue
+                if ('valid_alt' not in v or lh['altitude'] > v['valid_alt']) and self.is_location_in_cylinder(lh, v):
+                    if v['valid_team']:
+                        counters[v['valid_team']] += lh['timestamp'] - v['valid_time']
+                    v['valid_time']      = lh['timestamp']
+                    v['valid_team']      = lh['team_id']
+                    v['valid_team_name'] = lh['team_name']
+                    v['valid_alt']       = lh['altitude']
+        return self.add_held(counters, validations, self.get_compare_ts(igame)), validations
+
+class ReferenceDegressive(ReferenceScoring):
+    def __init__(self, degress_factor=1):
+        self.degress_factor = degress_factor
+
+    # The fix is above the altitude to beat, decayed since the capture
+    def beats(self, lh, v):
+        return 'valid_alt' not in v or lh['altitude'] > (v['valid_alt'] - self.degress_factor * (lh['timestamp'] - v['valid_time']))
+
+    # Flag still held at timestamp (degresslimit releases them)
+    def release(self, v, counters, timestamp):
+        return
+
+    def score_igame(self, igame):
+        counters = self.get_zero_counters(igame)
+        validations = self.get_game_cylinders(igame)
+        for lh in self.get_all_lh_dict_sorted(igame):
+            if lh['timestamp'] > igame.end_date.timestamp():
+                break
+            for v in validations:
+                if not lh['altitude']:
+                    continue
+                if haversine(lh['latitude'], lh['longitude'], v['lat'], v['lon']) > v['radius']:
+                    continue
+                self.release(v, counters, lh['timestamp'])
+                if self.is_location_in_cylinder(lh, v) and self.beats(lh, v):
+                    if v['valid_team']:
+                        counters[v['valid_team']] += lh['timestamp'] - v['valid_time']
+                    v['valid_time']      = lh['timestamp']
+                    v['valid_team']      = lh['team_id']
+                    v['valid_team_name'] = lh['team_name']
+                    v['valid_alt']       = lh['altitude']
+        compare_ts = self.get_compare_ts(igame)
+        for v in validations:
+            self.release(v, counters, compare_ts)
+        return self.add_held(counters, validations, compare_ts), validations
+
+class ReferenceDegressiveLimit(ReferenceDegressive):
+    def __init__(self, degress_factor=1, timeout=600):
+        self.degress_factor = degress_factor
+        self.timeout = timeout
+
+    def release(self, v, counters, timestamp):
+        if v['valid_team'] and timestamp - v['valid_time'] > self.timeout:
+            counters[v['valid_team']] += self.timeout
+            v['valid_time'] = v['valid_time'] + self.timeout
+            v['valid_team'] = None
+            v.pop('valid_alt', None)
+
+class ReferenceGroupMode(ReferenceScoring):
+    def __init__(self, group_size=2, window=60):
+        self.group_size = group_size
+        self.window = window
+
+    def score_igame(self, igame):
+        counters = self.get_zero_counters(igame)
+        validations = self.get_game_cylinders(igame)
+        # every fix seen in each cylinder, scanned back for the team mates
+        seen = [ [] for v in validations ]
+        for lh in self.get_all_lh_dict_sorted(igame):
+            if lh['timestamp'] > igame.end_date.timestamp():
+                break
+            for i, v in enumerate(validations):
+                if haversine(lh['latitude'], lh['longitude'], v['lat'], v['lon']) > v['radius']:
+                    continue
+                seen[i].append(lh)
+                members = set(f['member_id'] for f in seen[i]
+                              if f['team_id'] == lh['team_id'] and f['timestamp'] >= lh['timestamp'] - self.window)
+                if len(members) < self.group_size or not lh['altitude']:
+                    continue
+                if ('valid_alt' not in v or lh['altitude'] > v['valid_alt']) and self.is_location_in_cylinder(lh, v):
+                    if v['valid_team']:
+                        counters[v['valid_team']] += lh['timestamp'] - v['valid_time']
+                    v['valid_time']      = lh['timestamp']
+                    v['valid_team']      = lh['team_id']
+                    v['valid_team_name'] = lh['team_name']
+                    v['valid_alt']       = lh['altitude']
+        return self.add_held(counters, validations, self.get_compare_ts(igame)), validations
+
+REFERENCE_SCORINGS = {
+    'trad':         ReferenceTraditional,
+    'degress':      ReferenceDegressive,
+    'degresslimit': ReferenceDegressiveLimit,
+    'groupmode':    ReferenceGroupMode
+}
+
+# (counters, validations) of the igame with the reference of its scoring system
+def reference_score(igame):
+    return REFERENCE_SCORINGS.get(igame.scoring, ReferenceTraditional)().score_igame(igame)
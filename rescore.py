@@ -0,0 +1,77 @@
+# rescore.py
+# Scores igames again from their whole history on a pool of processes, e.g.
+# after a fix of a scoring system:
+#   python rescore.py                     every igame
+#   python rescore.py --over --save       finished igames, saving their final results again
+#   python rescore.py 3 5 8 --workers 4
+# Prints a JSON line per igame with its team scores.
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from game import GameManager
+
+
+# Worker processes running ScoringJobs. Scoring is pure python: in the server
+# threads, a long pass holds the GIL the request and ingest threads need.
+# Workers are forked when available, all at once when the pool is created
+# (before the server threads start, they only run ScoringJobs anyway).
+# Without workers, the jobs run in the calling thread.
+class ScoringPool():
+    def __init__(self, workers=None):
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.executor = None
+        if self.workers:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+            self.executor = ProcessPoolExecutor(self.workers, mp_context=context)
+            for f in [ self.executor.submit(int) for _ in range(self.workers) ]:
+                f.result()
+
+    def submit(self, job):
+        if self.executor is None:
+            future = Future()
+            future.set_result(job.run())
+            return future
+        return self.executor.submit(job.run)
+
+    # (validations, counters, groups) of a ScoringJob, waiting for it
+    def run(self, job):
+        return self.submit(job).result()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='score igames again on a pool of processes')
+    parser.add_argument('igames', type=int, nargs='*', help='igame ids (all by default)')
+    parser.add_argument('--db', default='sqlite:///game.db')
+    parser.add_argument('--workers', type=int, default=None, help='processes (one per CPU by default, 0 for none)')
+    parser.add_argument('--over', action='store_true', help='only the finished igames')
+    parser.add_argument('--save', action='store_true', help='save the final results of the finished igames')
+    args = parser.parse_args()
+
+    # before the manager: the workers don't inherit its connections
+    pool = ScoringPool(args.workers)
+    manager = GameManager(args.db)
+    try:
+        igames = manager.get_all_igames()
+        if args.igames:
+            igames = [ g for g in igames if g.id in args.igames ]
+        if args.over:
+            igames = [ g for g in igames if g.is_over() ]
+
+        start = time.perf_counter()
+        results = manager.rescore_igames([ g.id for g in igames ], pool, args.save)
+        for igame_id, scores in results.items():
+            print(json.dumps({ 'igame': igame_id, 'score': scores['score'] }))
+        print(json.dumps({ 'igames': len(results), 'workers': pool.workers, 'seconds': round(time.perf_counter() - start, 3) }))
+    finally:
+        pool.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+# roster.py
+import hashlib
+import hmac
+import threading
+import time
+from datetime import datetime
+from sqlalchemy.orm import selectinload
+from models import Game, Team, TeamMember, GameInstance
+
+# Seconds after which an igame is loaded again even without a notification
+# (changed by another process)
+ROSTER_MAX_AGE = 60
+
+
+def get_digest(password):
+    return hashlib.sha256(str(password).encode()).digest()
+
+
+# An igame of the roster: its window and the cylinders of its game (as
+# GameManager.get_game_cylinders)
+class RosterIgame():
+    def __init__(self, igame, cylinders, cylinder_ids):
+        self.igame_id     = igame.id
+        self.game_id      = igame.game_id
+        self.start_date   = igame.start_date
+        self.end_date     = igame.end_date
+        self.cylinders    = cylinders
+        self.cylinder_ids = cylinder_ids
+        self.loaded_at    = time.monotonic()
+
+    def is_on(self, now):
+        return self.start_date < now < self.end_date
+
+    def is_over(self, now):
+        return now > self.end_date
+
+
+# A member of the roster: digest of its password, team and igame
+class RosterMember():
+    def __init__(self, member_id, password, team_id, igame):
+        self.member_id = member_id
+        self.digest    = get_digest(password)
+        self.team_id   = team_id
+        self.igame     = igame
+
+    def check(self, password):
+        return password is not None and hmac.compare_digest(self.digest, get_digest(password))
+
+
+# Members of the running igames, to authenticate and route their positions
+# without reading the database. An igame is loaded with all its members the
+# first time one of them sends a position, and dropped on a notification
+# (a member joins, teams/game changed, igame deleted), when it is over, or
+# after ROSTER_MAX_AGE.
+class LiveRoster():
+    def __init__(self, manager, max_age=ROSTER_MAX_AGE):
+        self.manager = manager
+        self.max_age = max_age
+        # member id -> RosterMember
+        self.members = {}
+        # igame id -> (RosterIgame, [member ids])
+        self.igames = {}
+        # igame id -> time it was found over (its members aren't loaded anymore)
+        self.ended = {}
+        # increased by the notifications: an igame loaded meanwhile isn't kept
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    # GameManager igame listener
+    def on_igame(self, igame_id):
+        with self.lock:
+            self.generation += 1
+            self.drop(igame_id)
+            self.ended.pop(igame_id, None)
+
+    # The cylinders of a game changed
+    def on_game(self, game_id):
+        with self.lock:
+            self.generation += 1
+            for igame_id, (entry, member_ids) in list(self.igames.items()):
+                if entry.game_id == game_id:
+                    self.drop(igame_id)
+
+    def drop(self, igame_id):
+        entry, member_ids = self.igames.pop(igame_id, (None, []))
+        for member_id in member_ids:
+            self.members.pop(member_id, None)
+
+    def load(self, member_id):
+        session = self.manager.Session
+        igame_id = (session.query(Team.igame_id)
+                    .join(TeamMember, TeamMember.team_id == Team.id)
+                    .filter(TeamMember.id == member_id)
+                    .scalar())
+        if igame_id is None:
+            return None
+        with self.lock:
+            ended = self.ended.get(igame_id)
+            generation = self.generation
+        if ended is not None and time.monotonic() - ended <= self.max_age:
+            return None
+
+        igame = (session.query(GameInstance)
+                 .options(selectinload(GameInstance.game).selectinload(Game.cylinders))
+                 .filter(GameInstance.id == igame_id)
+                 .one_or_none())
+        if igame is None:
+            return None
+        entry = RosterIgame(igame, *self.manager.get_game_cylinders(igame.game))
+        members = (session.query(TeamMember.id, TeamMember.password, TeamMember.team_id)
+                   .join(Team, TeamMember.team_id == Team.id)
+                   .filter(Team.igame_id == igame_id)
+                   .all())
+        if entry.is_over(datetime.utcnow()):
+            with self.lock:
+                self.ended[igame_id] = time.monotonic()
+            return None
+        loaded = { m[0]: RosterMember(m[0], m[1], m[2], entry) for m in members }
+        with self.lock:
+            if generation == self.generation:
+                self.drop(igame_id)
+                self.igames[igame_id] = (entry, list(loaded))
+                self.members.update(loaded)
+        return loaded.get(member_id)
+
+    # RosterIgame of a loaded igame, None if it isn't
+    def get_igame(self, igame_id):
+        with self.lock:
+            entry, member_ids = self.igames.get(igame_id, (None, []))
+        return entry
+
+    # RosterMember of a member of a running igame, None if its password
+    # doesn't match or its igame isn't on
+    def get_member(self, member_id, password):
+        now = datetime.utcnow()
+        with self.lock:
+            member = self.members.get(member_id)
+            if member is not None and (member.igame.is_over(now) or time.monotonic() - member.igame.loaded_at > self.max_age):
+                if member.igame.is_over(now):
+                    self.ended[member.igame.igame_id] = time.monotonic()
+                self.drop(member.igame.igame_id)
+                member = None
+        if member is None:
+            member = self.load(member_id)
+        if member is None or not member.check(password) or not member.igame.is_on(now):
+            return None
+        return member
@@ -0,0 +1,206 @@
+# scoring_engine.py
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import insert, update
+from models import Team, TeamMember, LocationHistory, CylinderHit
+from scoring_models import ScoringFactory, ScoringJob
+from fixstream import FixStream, load_fix_stream
+from metrics import metrics
+
+# Locations per UPDATE when marking them classified
+CLASSIFY_CHUNK = 500
+
+# Igames whose scoring state is kept (least recently used ones are dropped)
+CACHE_SIZE = 64
+# Seconds after which the stored fixes are read again even without a
+# notification (fixes stored by another process)
+CACHE_MAX_AGE = 5
+# Fixes (inside a cylinder) from which a pass runs on the scoring pool, if any
+POOL_MIN_HITS = 2000
+
+# Keeps a ScoringState per igame between polls, so a poll only consumes the
+# fixes received since the previous one instead of replaying the whole history.
+# Only the fixes inside a cylinder (CylinderHit) are read, the others can't
+# change anything to the scoring.
+# The stored fixes are only read again after a notification of new ones
+# (touch) or CACHE_MAX_AGE: a poll of an unchanged igame only computes the
+# points accrued since.
+# With a ScoringPool (rescore.py), long passes run in its worker processes
+# and don't hold the GIL the request and ingest threads need.
+class IncrementalScoring():
+    def __init__(self, cache_size=CACHE_SIZE, max_age=CACHE_MAX_AGE, pool=None):
+        self.factory = ScoringFactory()
+        self.cache_size = cache_size
+        self.max_age = max_age
+        self.pool = pool
+        self.states = OrderedDict()
+        self.locks = {}
+        # igame id -> number of notifications of new fixes
+        self.touched = {}
+        self.lock = threading.Lock()
+        # hits: nothing read, updates: new fixes read, misses: state rebuilt
+        self.stats = { 'hits': 0, 'updates': 0, 'misses': 0, 'evictions': 0 }
+
+    # Anything that would change past scoring decisions. A state built on
+    # another revision is thrown away and rebuilt from the first fix.
+    def get_revision(self, igame):
+        return (igame.scoring,
+                igame.game_id,
+                igame.start_date,
+                igame.end_date,
+                tuple((c.id, c.latitude, c.longitude, c.radius) for c in igame.game.cylinders),
+                tuple(t.id for t in igame.teams))
+
+    def invalidate(self, igame_id=None):
+        with self.lock:
+            if igame_id is None:
+                self.states.clear()
+            else:
+                self.states.pop(igame_id, None)
+
+    # New fixes were stored for the igame
+    def touch(self, igame_id):
+        with self.lock:
+            self.touched[igame_id] = self.touched.get(igame_id, 0) + 1
+
+    # What a state read from the database is up to date with
+    def get_loaded(self, igame_id):
+        return (self.touched.get(igame_id, 0), time.monotonic())
+
+    def is_fresh(self, igame_id, state):
+        touched, loaded_at = state.loaded
+        return touched == self.touched.get(igame_id, 0) and time.monotonic() - loaded_at <= self.max_age
+
+    # GameManager location listener
+    def on_location(self, igame_id, position, scoring_changed):
+        # fixes outside the cylinders don't change anything
+        if scoring_changed:
+            self.touch(igame_id)
+
+    # GameManager igame listener: teams, members or game changed
+    def on_igame(self, igame_id):
+        self.invalidate(igame_id)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, igames=len(self.states))
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def keep(self, igame_id, state):
+        with self.lock:
+            self.states[igame_id] = state
+            self.states.move_to_end(igame_id)
+            while len(self.states) > self.cache_size:
+                self.states.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    # Locations stored before their game cylinders were known (or changed)
+    # are tested here, once, against the cylinders of the state
+    def classify_pending(self, session, igame_id, state, after_id=0):
+        rows = (session.query(LocationHistory.id, LocationHistory.latitude, LocationHistory.longitude)
+                .join(TeamMember, LocationHistory.team_member_id == TeamMember.id)
+                .join(Team, TeamMember.team_id == Team.id)
+                .filter(Team.igame_id == igame_id, LocationHistory.id > after_id,
+                        LocationHistory.classified.is_not(True))
+                .all())
+        if not rows:
+            return
+
+        hits = state.cylinders.hits([ r[1] for r in rows ], [ r[2] for r in rows ])
+        cylinder_hits = [ { 'location_id': rows[k][0], 'cylinder_id': state.validations[i]['cylinder_id'] }
+                          for k, idx in hits.items() for i in idx ]
+        if cylinder_hits:
+            session.execute(insert(CylinderHit), cylinder_hits)
+        for start in range(0, len(rows), CLASSIFY_CHUNK):
+            ids = [ r[0] for r in rows[start:start+CLASSIFY_CHUNK] ]
+            session.execute(update(LocationHistory).where(LocationHistory.id.in_(ids)).values(classified=True))
+        session.commit()
+
+    # Fixes of the igame inside a cylinder, with the indexes of the
+    # validations they hit
+    def load_locations(self, session, igame, state, after_id=0):
+        self.classify_pending(session, igame.id, state, after_id)
+
+        stream = load_fix_stream(session, igame, after_id, with_hits=True)
+        validation_index = { v['cylinder_id']: i for i, v in enumerate(state.validations) }
+        hits = {}
+        for k, cylinder_ids in stream.hits.items():
+            idx = sorted(validation_index[c] for c in cylinder_ids if c in validation_index)
+            if idx:
+                hits[k] = idx
+        return stream, hits
+
+    def consume(self, scoring, state, stream, hits):
+        if self.pool is not None and len(hits) >= POOL_MIN_HITS:
+            state.validations, state.counters, state.groups = self.pool.run(ScoringJob(scoring, state, stream, hits))
+        else:
+            scoring.consume(state, stream, hits)
+
+    def feed(self, scoring, state, stream, hits):
+        self.consume(scoring, state, stream, hits)
+        if len(stream):
+            state.last_key = stream.key(len(stream) - 1)
+            state.last_id = max(state.last_id, max(stream.ids))
+
+    def rebuild(self, session, scoring, igame, revision):
+        state = scoring.new_state(igame)
+        state.revision = revision
+        state.loaded = self.get_loaded(igame.id)
+        self.feed(scoring, state, *self.load_locations(session, igame, state))
+        self.keep(igame.id, state)
+        return state
+
+    # Copy of the state having also consumed fixes not stored yet (dicts of
+    # the IngestQueue). Those sorting before the stored ones are left out,
+    # they are consumed once stored.
+    def with_pending(self, scoring, state, pending):
+        stream = FixStream()
+        for fix in pending:
+            stream.append(0, fix['timestamp'].timestamp(), fix['latitude'], fix['longitude'], fix['altitude'],
+                          fix['team_member_id'], fix['team_id'])
+        stream.sort()
+        start = 0
+        while start < len(stream) and state.last_key and stream.key(start) < state.last_key:
+            start += 1
+        hits = { k: idx for k, idx in state.cylinders.hits(stream.latitudes, stream.longitudes).items() if k >= start }
+        if not hits:
+            return state
+        state = state.copy()
+        scoring.consume(state, stream, hits)
+        return state
+
+    # Returns the scoring system of the igame and its state, up to date with
+    # all the stored fixes (and the pending ones when given)
+    def get_state(self, session, igame, pending=None):
+        scoring = self.factory.get_scoring_system(igame.scoring)
+        revision = self.get_revision(igame)
+
+        model = type(scoring).__name__
+        if metrics.enabled:
+            metrics.add('scoring_runs', model=model)
+        with metrics.phase('scoring', model=model), self.locks.setdefault(igame.id, threading.Lock()):
+            state = self.states.get(igame.id)
+            if state is None or state.revision != revision:
+                self.count('misses')
+                state = self.rebuild(session, scoring, igame, revision)
+            else:
+                if not self.is_fresh(igame.id, state):
+                    self.count('updates')
+                    loaded = self.get_loaded(igame.id)
+                    stream, hits = self.load_locations(session, igame, state, state.last_id)
+                    if len(stream) and state.last_key and stream.key(0) < state.last_key:
+                        # a late fix sorts before already consumed ones
+                        state = self.rebuild(session, scoring, igame, revision)
+                    else:
+                        self.feed(scoring, state, stream, hits)
+                        state.loaded = loaded
+                else:
+                    self.count('hits')
+                self.keep(igame.id, state)
+            if pending:
+                state = self.with_pending(scoring, state, pending)
+            return scoring, state
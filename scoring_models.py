@@ -1,5 +1,61 @@
-from math import radians, sin, cos, sqrt, atan2
+from collections import deque
 from datetime import datetime
+from sqlalchemy.orm import object_session
+from geo import haversine, CylinderSet
+from fixstream import FixStream, load_fix_stream
+from metrics import metrics
+
+# Running state of a scoring pass over the chronological fix stream of an igame.
+# It can be kept between calls so that only the fixes received since the last
+# one (sort key above last_key) have to be consumed.
+class ScoringState():
+    def __init__(self, validations, cylinders, counters, team_names, end_ts):
+        self.validations = validations
+        self.cylinders   = cylinders
+        self.counters    = counters
+        self.team_names  = team_names
+        self.end_ts      = end_ts
+        # only used by the group mode: (validation index, team id) -> GroupWindow
+        self.groups      = {}
+        self.revision    = None
+        self.last_key    = None
+        self.last_id     = 0
+        # (notifications, time) of the last read of the stored fixes
+        self.loaded      = None
+
+    # Copy that can consume more fixes without changing this state
+    def copy(self):
+        state = ScoringState([ dict(v) for v in self.validations ], self.cylinders, dict(self.counters),
+                             self.team_names, self.end_ts)
+        state.groups   = { key: window.copy() for key, window in self.groups.items() }
+        state.revision = self.revision
+        state.last_key = self.last_key
+        state.last_id  = self.last_id
+        state.loaded   = self.loaded
+        return state
+
+# A scoring pass without any ORM object or session: the scoring system, the
+# validations and counters to start from and the fixes, all picklable to run
+# it in another process (see rescore.py). Without hits, the cylinders
+# containing the fixes are found by the process running it.
+class ScoringJob():
+    def __init__(self, scoring, state, stream, hits=None):
+        self.scoring     = scoring
+        self.validations = state.validations
+        self.counters    = state.counters
+        self.team_names  = state.team_names
+        self.end_ts      = state.end_ts
+        self.groups      = state.groups
+        self.stream      = stream
+        self.hits        = hits
+
+    # (validations, counters, groups) once the fixes are consumed
+    def run(self):
+        cylinders = self.scoring.get_cylinder_set(self.validations) if self.hits is None else None
+        state = ScoringState(self.validations, cylinders, self.counters, self.team_names, self.end_ts)
+        state.groups = self.groups
+        self.scoring.consume(state, self.stream, self.hits)
+        return state.validations, state.counters, state.groups
 
 # Abstract super class with some common helpers
 class Scoring():
@@ -7,17 +63,7 @@ class Scoring():
         return
 
     def haversine(self, lat1, lon1, lat2, lon2):
-        # Convert latitude and longitude from degrees to radians
-        lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-
-        # Haversine formula
-        dlat = lat2 - lat1
-        dlon = lon2 - lon1
-        a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
-        c = 2 * atan2(sqrt(a), sqrt(1 - a))
-        distance = 6371000 * c  # Radius of the Earth in meters
-
-        return distance
+        return haversine(lat1, lon1, lat2, lon2)
 
     def is_coordinate_within_circle(self, coord, center, radius):
         # coord and center should be tuples (latitude, longitude)
@@ -40,6 +86,11 @@ class Scoring():
             validations.append(valid)
         return validations
 
+    # Spatial index over the validations, to only test a fix against the
+    # cylinders it may be in
+    def get_cylinder_set(self, validations):
+        return CylinderSet([ (v['lat'], v['lon'], v['radius']) for v in validations ])
+
     def is_location_in_cylinder(self, lh, v):
         if isinstance(lh, dict):
             return self.is_coordinate_within_circle((lh['latitude'], lh['longitude']),(v['lat'], v['lon']),v['radius']) and v['valid_time'] < int(lh['timestamp'])
@@ -49,147 +100,270 @@ class Scoring():
     def score_igame(self, igame):
         return False
 
+    # Flag statuses, from the same chronological pass as score_igame_full
     def score_latest_update(self, igame):
-        return []
+        return self.score_igame_full(igame)['latest_score']
+
+    def get_compare_ts(self, igame):
+        compare_date = datetime.utcnow()
+        if compare_date > igame.end_date:
+            compare_date = igame.end_date
+        return compare_date.timestamp()
+
+    def new_state(self, igame):
+        validations = self.get_game_cylinders(igame)
+        return ScoringState(validations, self.get_cylinder_set(validations), self.get_zero_counters(igame),
+                            { t.id: t.name for t in igame.teams }, igame.end_date.timestamp())
+
+    # Chronological FixStream of all the fixes of the igame
+    def get_fix_stream(self, igame):
+        session = object_session(igame)
+        if session is None:
+            return FixStream.from_dicts(self.get_all_lh_dict_sorted(igame))
+        return load_fix_stream(session, igame)
+
+    # Feed a chronological FixStream to the state. Unless they are given
+    # ({fix index: [validation indexes]}), the cylinders containing each fix
+    # are found for the whole stream at once.
+    # Only the fixes inside a cylinder are passed to consume_location, the
+    # others can be left out of the stream.
+    def consume(self, state, stream, hits=None):
+        timestamps = stream.timestamps
+        count = len(stream)
+        while count and timestamps[count-1] > state.end_ts:
+            count -= 1
+        if hits is None:
+            hits = state.cylinders.hits(stream.latitudes[:count], stream.longitudes[:count])
+        if metrics.enabled:
+            metrics.add('scoring_fixes', count, model=type(self).__name__)
+        member_ids = stream.member_ids
+        team_ids   = stream.team_ids
+        altitudes  = stream.altitudes
+        for k, idx in hits.items():
+            if k >= count:
+                break
+            self.consume_location(state, timestamps[k], member_ids[k], team_ids[k], altitudes[k], idx)
+
+    # hits: indexes (ascending) of the validations whose cylinder contains the fix
+    def consume_location(self, state, timestamp, member_id, team_id, altitude, hits):
+        return
+
+    # Altitude a fix has to be above at timestamp to take the held flag v
+    def get_alt_to_beat(self, v, timestamp):
+        return v['valid_alt']
+
+    # Flag v taken by a fix of team_id, if later than its capture and higher
+    # than the altitude to beat: its holder gets the points of the hold.
+    # Returns True if taken.
+    def capture(self, state, v, team_id, timestamp, altitude):
+        if v['valid_time'] >= int(timestamp) or ('valid_alt' in v and altitude <= self.get_alt_to_beat(v, timestamp)):
+            return False
+        if v['valid_team']:
+            state.counters[v['valid_team']] += timestamp - v['valid_time']
+        v['valid_time']      = timestamp
+        v['valid_team']      = team_id
+        v['valid_team_name'] = state.team_names.get(team_id)
+        v['valid_alt']       = altitude
+        return True
+
+    # Flag statuses of the state, as returned by score_latest_update
+    def get_flags(self, state, igame, compare_ts):
+        colors = { t.id: t.get_color_hex() for t in igame.teams }
+        flags = []
+        for v in state.validations:
+            flag = dict(v)
+            if flag['valid_team']:
+                flag['valid_color'] = colors.get(flag['valid_team'])
+            flags.append(flag)
+        return flags
+
+    # Flags and team totals out of a single chronological pass
+    def score_igame_full(self, igame):
+        compare_ts = self.get_compare_ts(igame)
+        state = self.new_state(igame)
+        self.consume(state, self.get_fix_stream(igame))
+        return {
+            'latest_score': self.get_flags(state, igame, compare_ts),
+            'score':        self.get_counters(state, compare_ts)
+        }
+
+    # Counters of the state plus the points of the flags still held at compare_ts
+    def get_counters(self, state, compare_ts):
+        counters = dict(state.counters)
+        for v in state.validations:
+            if v['valid_team']:
+                to_add = compare_ts - v['valid_time']
+                counters[v['valid_team']] += to_add
+        return counters
 
     def get_zero_counters(self, igame):
         counters={ team.id: 0 for team in igame.teams }
         return counters
     
+    # Locations of the igame from its start, in scoring order
     def get_all_lh_dict_sorted(self, igame):
         all_locations = []
         for t in igame.teams:
             for m in t.members:
                 for lh in m.location_history:
+                    if lh.timestamp < igame.start_date:
+                        continue
                     all_locations.append( {
+                        'id':        lh.id,
                         'team_name': t.name,
                         'team_id':   t.id,
+                        'member_id': m.id,
                         'timestamp': lh.timestamp.timestamp(),
                         'latitude':  lh.latitude,
                         'longitude': lh.longitude,
                         'altitude':  lh.altitude
                     })
 
-        return sorted(all_locations, key=lambda x: x['timestamp'])
+        # same order as load_fix_stream
+        return sorted(all_locations, key=lambda x: (x['timestamp'], x['team_id'], x['member_id'], x['id']))
 
 class ScoringTraditional(Scoring):
     def __init__(self):
         super().__init__()
         
     def score_igame(self, igame):
-        counters = self.get_zero_counters(igame)
-        all_locations = self.get_all_lh_dict_sorted(igame)
-        validations = self.get_game_cylinders(igame)
-
-        for lh in all_locations:
-            if lh['timestamp'] > igame.end_date.timestamp():
-                break
-            for v in validations:
-                if not lh['altitude']:
-                    # sorry mate, need alti
-                    continue
-                if ('valid_alt' not in v or lh['altitude'] > v['valid_alt']) and self.is_location_in_cylinder(lh, v):
-                    if 'valid_team' in v and v['valid_team'] and 'valid_time' in v:
-                        to_add = lh['timestamp'] - v['valid_time']
-                        counters[v['valid_team']] += to_add
-                    v['valid_time']      = lh['timestamp']
-                    v['valid_team']      = lh['team_id']
-                    v['valid_team_name'] = lh['team_name']
-                    v['valid_alt']       = lh['altitude']
+        state = self.new_state(igame)
+        self.consume(state, self.get_fix_stream(igame))
 
         # Add the rest of the score compared to now()
-        compare_date = datetime.utcnow()
-        if compare_date > igame.end_date:
-            compare_date = igame.end_date
-        for v in validations:
-            if v['valid_team']:
-                to_add = compare_date.timestamp() - v['valid_time']
-                counters[v['valid_team']] += to_add
-            
-        return counters
+        return self.get_counters(state, self.get_compare_ts(igame))
 
-    def score_latest_update(self, igame):
-        validations = self.get_game_cylinders(igame)
-        
-        for t in igame.teams:
-            for m in t.members:
-                for lh in m.location_history: 
-                    for v in validations:
-                        if (self.is_location_in_cylinder(lh, v)
-                            and ('valid_alt' not in v or lh.altitude > v['valid_alt'])
-                            and ('valid_time' not in v or lh.timestamp.timestamp() > v['valid_time'])):
-                            v['valid_time'] = lh.timestamp.timestamp()
-                            v['valid_team'] = t.id
-                            v['valid_color'] = t.get_color_hex()
-                            v['valid_alt'] = lh.altitude
-
-        return (validations)
-
-# TBD
+    def consume_location(self, state, timestamp, member_id, team_id, altitude, hits):
+        if not altitude:
+            # sorry mate, need alti
+            return
+        for i in hits:
+            self.capture(state, state.validations[i], team_id, timestamp, altitude)
+
+# Same rules as trad, but the altitude to beat decreases by degress_factor
+# meters per second from the capture: a flag taken at altitude a at t0 is
+# taken by any altitude above a - degress_factor * (t - t0) at t, the time
+# of the fix. The scores only depend on the fixes, not on the time they are
+# asked, so the state is kept and extended as any other (see
+# IncrementalScoring). Points accrue between captures, as with trad.
 class DegressiveScoring(Scoring):
     def __init__(self, degress_factor=1):
         self.degress_factor = degress_factor
         super().__init__()
 
     def score_igame(self, igame):
-        counters = self.get_zero_counters(igame)
-        all_locations = self.get_all_lh_dict_sorted(igame)
-        validations = self.get_game_cylinders(igame)
+        state = self.new_state(igame)
+        self.consume(state, self.get_fix_stream(igame))
+        return self.get_counters(state, self.get_compare_ts(igame))
 
-        # Add the rest of the score compared to now()
-        compare_date = datetime.utcnow()
-        if compare_date > igame.end_date:
-            compare_date = igame.end_date
-        compare_date = compare_date.timestamp()
-        
-        for lh in all_locations:
-            if lh['timestamp'] > igame.end_date.timestamp():
-                break
-            for v in validations:
-                if not lh['altitude']:
-                    continue
-                if (self.is_location_in_cylinder(lh, v)
-                    and ('valid_alt'  not in v or lh['altitude'] > (v['valid_alt']  - self.degress_factor * (compare_date-v['valid_time'])))
-                    and ('valid_time' not in v or lh['timestamp'] > v['valid_time'])):
-                    if 'valid_team' in v and v['valid_team'] and 'valid_time' in v:
-                        to_add = lh['timestamp'] - v['valid_time']
-                        counters[v['valid_team']] += to_add
-                    v['valid_time']      = lh['timestamp']
-                    v['valid_team']      = lh['team_id']
-                    v['valid_team_name'] = lh['team_name']
-                    v['valid_alt']       = lh['altitude']
-
-        for v in validations:
+    # Altitude to beat at timestamp on a held flag
+    def get_decayed_alt(self, v, timestamp):
+        return v['valid_alt'] - self.degress_factor * (timestamp - v['valid_time'])
+
+    def get_alt_to_beat(self, v, timestamp):
+        return self.get_decayed_alt(v, timestamp)
+
+    def consume_location(self, state, timestamp, member_id, team_id, altitude, hits):
+        if not altitude:
+            return
+        for i in hits:
+            self.capture(state, state.validations[i], team_id, timestamp, altitude)
+
+    def get_flags(self, state, igame, compare_ts):
+        flags = super().get_flags(state, igame, compare_ts)
+        for v in flags:
+            if 'valid_alt' in v:
+                v['valid_alt'] = max(0, self.get_decayed_alt(v, compare_ts))
+        return flags
+
+# degress, but a flag is held for timeout seconds at most after it was
+# taken (or taken again by its team): it must be recaptured to score again.
+# The flags are released lazily, when a fix hits them or when scored.
+class DegressiveLimitScoring(DegressiveScoring):
+    def __init__(self, degress_factor=1, timeout=600):
+        self.timeout = timeout
+        super().__init__(degress_factor)
+
+    def is_expired(self, v, timestamp):
+        return v['valid_team'] and timestamp - v['valid_time'] > self.timeout
+
+    # Flag released at the end of its timeout, its team getting the points of it
+    def release(self, v, counters):
+        counters[v['valid_team']] += self.timeout
+        v['valid_time']      = v['valid_time'] + self.timeout
+        v['valid_team']      = None
+        v['valid_team_name'] = None
+        v['valid_color']     = None
+        v.pop('valid_alt', None)
+
+    def consume_location(self, state, timestamp, member_id, team_id, altitude, hits):
+        if not altitude:
+            return
+        for i in hits:
+            v = state.validations[i]
+            if self.is_expired(v, timestamp):
+                self.release(v, state.counters)
+        super().consume_location(state, timestamp, member_id, team_id, altitude, hits)
+
+    def get_counters(self, state, compare_ts):
+        counters = dict(state.counters)
+        for v in state.validations:
             if v['valid_team']:
-                to_add = compare_date - v['valid_time']
-                counters[v['valid_team']] += to_add
-            
+                counters[v['valid_team']] += min(compare_ts - v['valid_time'], self.timeout)
         return counters
 
+    def get_flags(self, state, igame, compare_ts):
+        flags = super().get_flags(state, igame, compare_ts)
+        for v in flags:
+            if self.is_expired(v, compare_ts):
+                self.release(v, { v['valid_team']: 0 })
+        return flags
 
-    def score_latest_update(self, igame):
-        validations = self.get_game_cylinders(igame)
-        compare_date = datetime.utcnow().timestamp()
-        
-        for t in igame.teams:
-            for m in t.members:
-                for lh in m.location_history: 
-                    for v in validations:
-                        if (self.is_location_in_cylinder(lh, v)
-                            and ('valid_alt' not in v or lh.altitude > (v['valid_alt']  - self.degress_factor * (compare_date-v['valid_time'])))
-                            and ('valid_time' not in v or lh.timestamp.timestamp() > v['valid_time'])):
-                            v['valid_time'] = lh.timestamp.timestamp()
-                            v['valid_team'] = t.id
-                            v['valid_color'] = t.get_color_hex()
-                            v['valid_alt'] = lh.altitude
-
-        for v in validations:
-            if 'valid_alt' in v:
-                v['valid_alt'] = max(0,v['valid_alt']  - self.degress_factor * (compare_date-v['valid_time']))
-        return (validations)
-        
-        return
-                                    
+
+# Members of a team seen in a cylinder over the last window seconds: their
+# fixes in a deque, oldest first, and the count of fixes per member in it.
+# Adding a fix and dropping the expired ones is amortized O(1).
+class GroupWindow():
+    def __init__(self, window):
+        self.window  = window
+        self.fixes   = deque()
+        self.members = {}
+
+    # Add a fix, returns the number of members seen since timestamp - window
+    def add(self, timestamp, member_id):
+        fixes, members = self.fixes, self.members
+        while fixes and fixes[0][0] < timestamp - self.window:
+            expired = fixes.popleft()[1]
+            members[expired] -= 1
+            if not members[expired]:
+                del members[expired]
+        fixes.append((timestamp, member_id))
+        members[member_id] = members.get(member_id, 0) + 1
+        return len(members)
+
+    def copy(self):
+        window = GroupWindow(self.window)
+        window.fixes   = deque(self.fixes)
+        window.members = dict(self.members)
+        return window
+
+# Traditional rules, but a flag is captured by a team only when group_size
+# of its pilots have been in the cylinder within window seconds: the fix
+# of the last one of them takes it, if higher than the holder.
+class GroupModeScoring(ScoringTraditional):
+    def __init__(self, group_size=2, window=60):
+        self.group_size = group_size
+        self.window = window
+        super().__init__()
+
+    def consume_location(self, state, timestamp, member_id, team_id, altitude, hits):
+        for i in hits:
+            window = state.groups.get((i, team_id))
+            if window is None:
+                window = state.groups[(i, team_id)] = GroupWindow(self.window)
+            # pilots without altitude are there too, they just can't take the flag
+            if window.add(timestamp, member_id) >= self.group_size and altitude:
+                self.capture(state, state.validations[i], team_id, timestamp, altitude)
 
 
 class ScoringFactory():
@@ -206,6 +380,12 @@ class ScoringFactory():
         if system == 'degress':
             return DegressiveScoring(1)
 
+        if system == 'degresslimit':
+            return DegressiveLimitScoring(1, 600)
+
+        if system == 'groupmode':
+            return GroupModeScoring(2, 60)
+
         # default
         return ScoringTraditional()
         
@@ -0,0 +1,42 @@
+# storage.py
+from sqlalchemy import create_engine, event, inspect, text
+
+# Pragmas of the SQLite connections for the live games: WAL lets the scoring
+# read while a fix is written and makes commits cheaper (synchronous=NORMAL
+# only fsyncs at checkpoints), with a bigger page cache and a busy timeout
+# instead of failing on a locked database.
+SQLITE_PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-20000',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA busy_timeout=5000',
+]
+
+def create_storage_engine(db_url, tuned=True, **kwargs):
+    engine = create_engine(db_url, **kwargs)
+    if tuned and engine.dialect.name == 'sqlite':
+        @event.listens_for(engine, 'connect')
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma in SQLITE_PRAGMAS:
+                cursor.execute(pragma)
+            cursor.close()
+    return engine
+
+# create_all only creates the missing tables (and their indexes). Bring an
+# existing game.db up to date with the models: add the columns added since
+# (all nullable) and create the missing indexes.
+def upgrade_schema(engine, metadata):
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = { c['name'] for c in inspector.get_columns(table.name) }
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(engine.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
@@ -0,0 +1,148 @@
+# synthetic.py
+import random
+from math import radians, cos, sin, pi, atan2, sqrt
+from datetime import datetime, timedelta
+from models import Cylinder, TeamMember
+
+# Meters per degree of latitude
+METERS_PER_DEGREE = 111320
+
+# Flying area, around Chamonix
+BASE_LATITUDE  = 45.92
+BASE_LONGITUDE = 6.87
+AREA_SIZE      = 15000   # meters
+
+# Flight model (meters, seconds)
+GLIDE_SPEED    = 10.0
+GLIDE_SINK     = 1.2
+THERMAL_RADIUS = 60.0
+THERMAL_SPEED  = 9.0
+THERMAL_CLIMB  = (0.8, 3.0)
+CLOUD_BASE     = (2200.0, 3200.0)
+LOW_ALTITUDE   = 900.0
+# Seconds spent climbing over a flag to outclimb its holder
+BATTLE_TIME    = (120, 600)
+# GPS noise (meters) and share of fixes without altitude
+GPS_NOISE      = 3.0
+MISSING_ALTITUDE = 0.01
+
+
+# A synthetic igame: cylinders and, per team, the fixes of its pilots
+# (seconds since the start, latitude, longitude, altitude)
+class SyntheticIgame():
+    def __init__(self, cylinders, teams, duration, fix_rate):
+        self.cylinders = cylinders
+        self.teams = teams
+        self.duration = duration
+        self.fix_rate = fix_rate
+
+    def fix_count(self):
+        return sum(len(track) for tracks in self.teams for track in tracks)
+
+
+def to_degrees(x, y):
+    return (BASE_LATITUDE + y / METERS_PER_DEGREE,
+            BASE_LONGITUDE + x / (METERS_PER_DEGREE * cos(radians(BASE_LATITUDE))))
+
+# One pilot: glides to a flag, thermals on the way when too low, then circles
+# over the flag to climb above whoever holds it, and moves on to another one
+def fly(flags, duration, fix_rate, rnd):
+    x, y = rnd.uniform(-1000, 1000), rnd.uniform(-1000, 1000)
+    altitude = rnd.uniform(1500, 2200)
+    cloud_base = rnd.uniform(*CLOUD_BASE)
+    target = rnd.randrange(len(flags))
+    mode = 'glide'
+    center = None
+    angle = 0.0
+    climb = 0.0
+    until = 0
+
+    track = []
+    t = rnd.uniform(0, fix_rate)
+    while t < duration:
+        if mode == 'glide':
+            fx, fy, radius = flags[target]
+            dx, dy = fx - x, fy - y
+            distance = sqrt(dx * dx + dy * dy)
+            if distance < radius * 0.7:
+                # over the flag: battle for it
+                mode = 'battle'
+                center = (fx + rnd.uniform(-radius, radius) * 0.3, fy + rnd.uniform(-radius, radius) * 0.3)
+                climb = rnd.uniform(*THERMAL_CLIMB)
+                until = t + rnd.uniform(*BATTLE_TIME)
+            elif altitude < LOW_ALTITUDE:
+                mode = 'thermal'
+                center = (x + rnd.uniform(-200, 200), y + rnd.uniform(-200, 200))
+                climb = rnd.uniform(*THERMAL_CLIMB)
+            else:
+                heading = atan2(dy, dx) + rnd.gauss(0, 0.1)
+                x += cos(heading) * GLIDE_SPEED * fix_rate
+                y += sin(heading) * GLIDE_SPEED * fix_rate
+                altitude -= GLIDE_SINK * fix_rate
+        else:
+            # thermalling spiral around center
+            angle += THERMAL_SPEED * fix_rate / THERMAL_RADIUS
+            x = center[0] + cos(angle) * THERMAL_RADIUS
+            y = center[1] + sin(angle) * THERMAL_RADIUS
+            altitude = min(cloud_base, altitude + climb * fix_rate)
+            if mode == 'thermal' and altitude >= cloud_base - 50:
+                mode = 'glide'
+            elif mode == 'battle' and t >= until:
+                mode = 'glide'
+                target = rnd.choice([ k for k in range(len(flags)) if k != target ] or [target])
+
+        lat, lon = to_degrees(x + rnd.gauss(0, GPS_NOISE), y + rnd.gauss(0, GPS_NOISE))
+        track.append((t, lat, lon, None if rnd.random() < MISSING_ALTITUDE else round(altitude + rnd.gauss(0, GPS_NOISE), 1)))
+        t += fix_rate
+    return track
+
+def generate_igame(teams=4, pilots=5, cylinders=10, fix_rate=5, duration=3*3600, seed=1):
+    rnd = random.Random(seed)
+    flags = []
+    for _ in range(cylinders):
+        r = rnd.uniform(0, AREA_SIZE / 2)
+        a = rnd.uniform(0, 2 * pi)
+        flags.append((r * cos(a), r * sin(a), rnd.choice([200, 300, 400, 500])))
+    cylinder_list = [ to_degrees(fx, fy) + (radius,) for fx, fy, radius in flags ]
+    tracks = [ [ fly(flags, duration, fix_rate, rnd) for _ in range(pilots) ] for _ in range(teams) ]
+    return SyntheticIgame(cylinder_list, tracks, duration, fix_rate)
+
+
+# Store a synthetic igame through the GameManager: game, igame, teams, members
+# and their fixes (classified as when received). Over by default, starting
+# start (UTC) otherwise. Returns the igame id.
+def load_igame(manager, synthetic, scoring='trad', start=None, chunk=5000):
+    game = manager.create_game('synthetic', [ Cylinder(lat, lon, radius) for lat, lon, radius in synthetic.cylinders ])
+    igame = manager.create_igame('synthetic', game.id)
+    if start is None:
+        start = datetime.utcnow() - timedelta(seconds=synthetic.duration + 3600)
+    igame.start_date = start
+    igame.end_date = start + timedelta(seconds=synthetic.duration)
+    igame.scoring = scoring
+    manager.Session.commit()
+    igame_id = igame.id
+
+    members = []
+    for t, tracks in enumerate(synthetic.teams):
+        team = manager.create_team(igame_id, 'team %d' % t)
+        members.extend((TeamMember('pilot %d' % p, team.id), track) for p, track in enumerate(tracks))
+    manager.Session.add_all([ member for member, track in members ])
+    manager.Session.commit()
+    manager.notify_igame(igame_id)
+
+    rows = []
+    for member, track in members:
+        rows.extend({
+            'team_member_id': member.id,
+            'latitude':       lat,
+            'longitude':      lon,
+            'altitude':       altitude,
+            'timestamp':      start + timedelta(seconds=ts),
+            'classified':     True
+        } for ts, lat, lon, altitude in track)
+
+    cylinders = manager.get_game_cylinders(manager.find_game_by_id(game.id))
+    for k in range(0, len(rows), chunk):
+        manager.insert_locations(rows[k:k+chunk], *cylinders)
+    manager.Session.commit()
+    return igame_id
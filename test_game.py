@@ -0,0 +1,135 @@
+# test_game.py
+# python -m pytest -q
+import io
+import pytest
+import time
+from datetime import datetime, timedelta
+from xml.etree.ElementTree import ParseError
+from sqlalchemy import func
+from game import GameManager
+from ingest import IngestQueue
+from models import IgameResult, LocationHistory, TeamMember
+from scoring_models import ScoringFactory
+from synthetic import generate_igame, load_igame
+from tracks import guess_format, parse_igc, parse_gpx, write_igc
+
+
+@pytest.fixture
+def manager(tmp_path):
+    manager = GameManager('sqlite:///%s' % (tmp_path / 'game.db'))
+    yield manager
+    manager.Session.remove()
+    manager.engine.dispose()
+
+
+def test_delete_finalized_igame(manager):
+    igame_id = load_igame(manager, generate_igame(teams=2, pilots=2, cylinders=4, duration=600))
+    igame = manager.find_igame_by_id(igame_id)
+    assert manager.finalize_igame(igame) is not None
+    assert manager.Session.get(IgameResult, igame_id) is not None
+
+    assert manager.delete_igame(igame_id)
+    assert manager.find_igame_by_id(igame_id) is None
+    assert manager.Session.get(IgameResult, igame_id) is None
+
+
+def test_ingest_keeps_good_fixes(manager):
+    synthetic = generate_igame(teams=1, pilots=2, cylinders=2, duration=3600)
+    load_igame(manager, synthetic, start=datetime.utcnow() - timedelta(seconds=60))
+    members = manager.Session.query(TeamMember).order_by(TeamMember.id).all()
+    stored = manager.Session.query(func.count(LocationHistory.id)).scalar()
+
+    ingest = IngestQueue(manager, batch_delay=1)
+    assert ingest.put(members[0].id, members[0].password, 45.0, 6.0, 1000)
+    assert ingest.put(members[1].id, members[1].password, 'abc', 6.0, 1000)
+    assert ingest.put(members[1].id, members[1].password, 45.1, 6.1, 1100)
+    ingest.close()
+    manager.Session.remove()
+    assert manager.Session.query(func.count(LocationHistory.id)).scalar() == stored + 2
+
+
+def test_last_position_after_late_upload(manager):
+    synthetic = generate_igame(teams=1, pilots=1, cylinders=2, duration=3600)
+    load_igame(manager, synthetic, start=datetime.utcnow() - timedelta(seconds=600))
+    member = manager.Session.query(TeamMember).one()
+    # the synthetic track goes on after now
+    manager.delete_member_fixes(member.id)
+    manager.Session.commit()
+    manager.update_team_member_location(member.id, member.password, 45.5, 6.5, 1500)
+    # backlog of a phone that lost its connection, stored after the live fix
+    now = time.time()
+    locations = [ { 'latitude': 45.0, 'longitude': 6.0, 'altitude': 1000, 'timestamp': now - 60 + k } for k in range(10) ]
+    assert manager.update_team_member_locations(member.id, member.password, locations) == 10
+
+    last = manager.get_last_positions([ member.id ])[member.id]
+    assert (last.latitude, last.longitude, last.altitude) == (45.5, 6.5, 1500)
+
+
+def test_groupmode_without_session(manager):
+    igame_id = load_igame(manager, generate_igame(teams=2, pilots=3, cylinders=3, duration=1800), scoring='groupmode')
+    igame = manager.find_igame_by_id(igame_id)
+    scoring = ScoringFactory().get_scoring_system('groupmode')
+    expected = scoring.score_igame_full(igame)
+    assert any(f['valid_team'] for f in expected['latest_score'])
+
+    # detached igame: the fixes are read from its loaded members
+    for t in igame.teams:
+        for m in t.members:
+            m.location_history
+    igame.game.cylinders
+    manager.Session.expunge_all()
+    assert scoring.score_igame_full(igame) == expected
+
+
+def test_parse_igc():
+    igc = (b'AXXXPARACTF\r\n'
+           b'HFDTE150724\r\n'
+           b'B2359585206343N00006198WA0058700558\r\n'
+           b'B0000054512000S00612000EA0060000000\r\n'
+           b'B00001X5206343N00006198WA0058700558\r\n'
+           b'B0001\r\n')
+    assert guess_format(igc[:64]) == 'igc'
+    fixes = list(parse_igc(io.BytesIO(igc)))
+    # malformed and short B records are left out
+    assert len(fixes) == 2
+    timestamp, latitude, longitude, altitude = fixes[0]
+    assert timestamp == datetime(2024, 7, 15, 23, 59, 58)
+    assert latitude == pytest.approx(52 + 6.343 / 60)
+    assert longitude == pytest.approx(-6.198 / 60)
+    assert altitude == 558
+    # past midnight, southern latitude, pressure altitude without GNSS
+    assert fixes[1] == (datetime(2024, 7, 16, 0, 0, 5), pytest.approx(-45.2), pytest.approx(6.2), 600)
+
+def test_parse_igc_without_date():
+    igc = b'B1200005206343N00006198WA0058700558\r\n'
+    assert list(parse_igc(io.BytesIO(igc))) == []
+    fixes = list(parse_igc(io.BytesIO(igc), datetime(2024, 7, 15, 9, 30)))
+    assert [ f[0] for f in fixes ] == [ datetime(2024, 7, 15, 12) ]
+
+def test_igc_round_trip():
+    fixes = [ (datetime(2024, 7, 15, 12, 0, s), 45.5 + s / 1000, -6.25, 1000 + s) for s in range(3) ]
+    igc = ''.join(write_igc('pilot', fixes)).encode()
+    parsed = list(parse_igc(io.BytesIO(igc)))
+    assert [ f[0] for f in parsed ] == [ f[0] for f in fixes ]
+    assert [ f[1] for f in parsed ] == [ pytest.approx(f[1], abs=1e-5) for f in fixes ]
+    assert [ f[2] for f in parsed ] == [ pytest.approx(f[2], abs=1e-5) for f in fixes ]
+
+def test_parse_gpx():
+    gpx = (b'<?xml version="1.0"?>\n'
+           b'<gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1"><trk><trkseg>'
+           b'<trkpt lat="45.5" lon="6.25"><ele>1234.5</ele><time>2024-07-15T12:00:00Z</time></trkpt>'
+           b'<trkpt lat="45.6" lon="6.35"><time>2024-07-15T14:00:01+02:00</time></trkpt>'
+           b'<trkpt lat="45.7" lon="6.45"><ele>1000</ele></trkpt>'
+           b'<trkpt lat="north" lon="6.45"><time>2024-07-15T12:00:02Z</time></trkpt>'
+           b'</trkseg></trk></gpx>')
+    assert guess_format(gpx[:64]) == 'gpx'
+    # points without a time or with invalid coordinates are left out
+    assert list(parse_gpx(io.BytesIO(gpx))) == [
+        (datetime(2024, 7, 15, 12, 0, 0), 45.5, 6.25, 1234.5),
+        (datetime(2024, 7, 15, 12, 0, 1), 45.6, 6.35, None)
+    ]
+
+def test_parse_malformed_gpx():
+    with pytest.raises(ParseError):
+        list(parse_gpx(io.BytesIO(b'<gpx><trk><trkpt lat="45.5" lon="6.25"></trk>')))
+    assert guess_format(b'PK\x03\x04') is None
@@ -0,0 +1,124 @@
+# timeline.py
+import threading
+from collections import OrderedDict
+from math import floor
+from scoring_models import ScoringFactory
+
+# Seconds of game time between two checkpoints of the scoring state
+CHECKPOINT_INTERVAL = 300
+# Igames whose timeline is kept (least recently used ones are dropped)
+TIMELINE_CACHE_SIZE = 8
+
+
+# Fixes of an igame inside a cylinder, in scoring order, with a copy of the
+# scoring state every interval seconds from the start of the igame: the
+# state at any instant is the one of the checkpoint before it plus at most
+# interval seconds of fixes, however long the igame.
+class ScoringTimeline():
+    def __init__(self, scoring, igame, revision, interval=CHECKPOINT_INTERVAL):
+        self.scoring  = scoring
+        self.revision = revision
+        self.interval = interval
+        self.start_ts = igame.start_date.timestamp()
+        # state before any fix, and after all of them
+        self.initial  = scoring.new_state(igame)
+        self.state    = self.initial.copy()
+        # (timestamp, member id, team id, altitude, validation indexes)
+        self.fixes    = []
+        # checkpoint n: (fixes consumed, state) at start_ts + n * interval
+        self.checkpoints = []
+        self.last_key = None
+        self.last_id  = 0
+        self.loaded   = None
+
+    def get_checkpoint_ts(self, n):
+        return self.start_ts + n * self.interval
+
+    # Fixes stored since, as loaded by IncrementalScoring.load_locations
+    def extend(self, stream, hits):
+        for k, idx in hits.items():
+            fix = (stream.timestamps[k], stream.member_ids[k], stream.team_ids[k], stream.altitudes[k], idx)
+            while fix[0] > self.get_checkpoint_ts(len(self.checkpoints)):
+                self.checkpoints.append((len(self.fixes), self.state.copy()))
+            self.scoring.consume_location(self.state, *fix)
+            self.fixes.append(fix)
+        if len(stream):
+            self.last_key = stream.key(len(stream) - 1)
+            self.last_id = max(self.last_id, max(stream.ids))
+
+    # Scoring state after the fixes up to timestamp
+    def state_at(self, timestamp):
+        consumed, state = 0, self.initial
+        if self.checkpoints:
+            n = min(floor((timestamp - self.start_ts) / self.interval), len(self.checkpoints) - 1)
+            if n >= 0:
+                consumed, state = self.checkpoints[n]
+        state = state.copy()
+        for fix in self.fixes[consumed:]:
+            if fix[0] > timestamp:
+                break
+            self.scoring.consume_location(state, *fix)
+        return state
+
+
+# Timelines of the igames, kept up to date with the stored fixes as the
+# scoring states of the IncrementalScoring they read them with
+class ScoringTimelines():
+    def __init__(self, scoring_engine, cache_size=TIMELINE_CACHE_SIZE, interval=CHECKPOINT_INTERVAL):
+        self.scoring_engine = scoring_engine
+        self.factory = ScoringFactory()
+        self.cache_size = cache_size
+        self.interval = interval
+        self.timelines = OrderedDict()
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    # GameManager igame listener
+    def on_igame(self, igame_id):
+        with self.lock:
+            self.timelines.pop(igame_id, None)
+
+    def keep(self, igame_id, timeline):
+        with self.lock:
+            self.timelines[igame_id] = timeline
+            self.timelines.move_to_end(igame_id)
+            while len(self.timelines) > self.cache_size:
+                self.timelines.popitem(last=False)
+
+    def build(self, session, scoring, igame, revision):
+        engine = self.scoring_engine
+        timeline = ScoringTimeline(scoring, igame, revision, self.interval)
+        timeline.loaded = engine.get_loaded(igame.id)
+        timeline.extend(*engine.load_locations(session, igame, timeline.state))
+        return timeline
+
+    def get_timeline(self, session, igame):
+        engine = self.scoring_engine
+        scoring = self.factory.get_scoring_system(igame.scoring)
+        revision = engine.get_revision(igame)
+        with self.locks.setdefault(igame.id, threading.Lock()):
+            timeline = self.timelines.get(igame.id)
+            if timeline is None or timeline.revision != revision:
+                timeline = self.build(session, scoring, igame, revision)
+            elif not engine.is_fresh(igame.id, timeline):
+                loaded = engine.get_loaded(igame.id)
+                stream, hits = engine.load_locations(session, igame, timeline.state, timeline.last_id)
+                if len(stream) and timeline.last_key and stream.key(0) < timeline.last_key:
+                    # a late fix sorts before already consumed ones
+                    timeline = self.build(session, scoring, igame, revision)
+                else:
+                    timeline.extend(stream, hits)
+                    timeline.loaded = loaded
+            self.keep(igame.id, timeline)
+            return timeline
+
+    # Flags and team totals of the igame at timestamp (not after its end or now)
+    def score_at(self, session, igame, timestamp):
+        timeline = self.get_timeline(session, igame)
+        timestamp = min(timestamp, timeline.scoring.get_compare_ts(igame))
+        state = timeline.state_at(timestamp)
+        return {
+            'latest_score': timeline.scoring.get_flags(state, igame, timestamp),
+            'score':        timeline.scoring.get_counters(state, timestamp),
+            'timestamp':    timestamp
+        }
@@ -0,0 +1,183 @@
+# tracks.py
+# Track files: IGC/GPX parsing for the imports, IGC/GPX/GeoJSON writers for
+# the exports. Parsers read a file object line by line (or element by
+# element) and yield fixes, writers take fix iterators and yield text: a
+# whole track is never held in memory.
+# A fix is (timestamp, latitude, longitude, altitude), timestamp a naive UTC
+# datetime as stored, altitude None when unknown.
+import json
+from datetime import datetime, timedelta, timezone
+from xml.etree.ElementTree import iterparse
+from xml.sax.saxutils import escape
+
+FORMATS = {
+    'igc':     'application/vnd.fai.igc',
+    'gpx':     'application/gpx+xml',
+    'geojson': 'application/geo+json',
+}
+
+GPX_NAMESPACE = 'http://www.topografix.com/GPX/1/1'
+
+
+# Format of an uploaded file from its first bytes, None if unknown
+def guess_format(head):
+    head = head.lstrip(b'\xef\xbb\xbf \t\r\n')
+    if head.startswith(b'<'):
+        return 'gpx'
+    if head[:1] in (b'A', b'H', b'B'):
+        return 'igc'
+    return None
+
+def parse_track(stream, format, default_date=None):
+    if format == 'igc':
+        return parse_igc(stream, default_date)
+    if format == 'gpx':
+        return parse_gpx(stream)
+    raise ValueError('unknown track format %s' % format)
+
+
+# B records of an IGC file (binary lines). The date comes from the HFDTE
+# header (default_date without it), a time going back means the next day.
+# The GNSS altitude is used, the pressure one when the GNSS one is missing.
+def parse_igc(stream, default_date=None):
+    day = None
+    last_seconds = None
+    for line in stream:
+        if line.startswith(b'B') and len(line) >= 35:
+            try:
+                seconds = int(line[1:3]) * 3600 + int(line[3:5]) * 60 + int(line[5:7])
+                latitude  = int(line[7:9])  + int(line[9:14])  / 60000
+                longitude = int(line[15:18]) + int(line[18:23]) / 60000
+                pressure_altitude = int(line[25:30])
+                gnss_altitude     = int(line[30:35])
+            except ValueError:
+                continue
+            if line[14:15] == b'S':
+                latitude = -latitude
+            if line[23:24] == b'W':
+                longitude = -longitude
+            if day is None:
+                if default_date is None:
+                    continue
+                day = datetime(default_date.year, default_date.month, default_date.day)
+            if last_seconds is not None and seconds < last_seconds:
+                day += timedelta(days=1)
+            last_seconds = seconds
+            altitude = gnss_altitude or pressure_altitude or None
+            yield (day + timedelta(seconds=seconds), latitude, longitude, altitude)
+        elif line.startswith(b'HFDTE'):
+            # HFDTEDDMMYY or HFDTEDATE:DDMMYY,NN
+            digits = line[5:].split(b':')[-1][:6]
+            try:
+                day = datetime(2000 + int(digits[4:6]), int(digits[2:4]), int(digits[0:2]))
+            except ValueError:
+                pass
+            last_seconds = None
+
+# Track points of a GPX file, whatever its namespace. Points without a
+# time are left out.
+def parse_gpx(stream):
+    for event, element in iterparse(stream, events=('end',)):
+        tag = element.tag.rsplit('}', 1)[-1]
+        if tag != 'trkpt':
+            if tag == 'trkseg':
+                element.clear()
+            continue
+        values = { child.tag.rsplit('}', 1)[-1]: child.text for child in element }
+        try:
+            fix = (parse_time(values['time']), float(element.get('lat')), float(element.get('lon')),
+                   float(values['ele']) if values.get('ele') else None)
+        except (KeyError, TypeError, ValueError):
+            fix = None
+        element.clear()
+        if fix is not None:
+            yield fix
+
+# ISO 8601 time of a GPX point, as a naive UTC datetime
+def parse_time(value):
+    timestamp = datetime.fromisoformat(value.strip())
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+# Small chunks joined into about size characters, for the streamed responses
+def buffered(chunks, size=65536):
+    buffer, length = [], 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def format_coordinate(value, degree_digits, positive, negative):
+    hemisphere = positive if value >= 0 else negative
+    value = abs(value)
+    degrees = int(value)
+    # minutes in thousandths, rounding may carry into the degrees
+    minutes = int(round((value - degrees) * 60000))
+    if minutes == 60000:
+        degrees, minutes = degrees + 1, 0
+    return '%0*d%05d%s' % (degree_digits, degrees, minutes, hemisphere)
+
+# IGC file of a pilot
+def write_igc(name, fixes):
+    header = False
+    for timestamp, latitude, longitude, altitude in fixes:
+        if latitude is None or longitude is None:
+            continue
+        if not header:
+            yield 'AXXXPARACTF\r\n'
+            yield 'HFDTE%s\r\n' % timestamp.strftime('%d%m%y')
+            yield 'HFPLTPILOTINCHARGE:%s\r\n' % name.replace('\r', ' ').replace('\n', ' ')
+            header = True
+        altitude = max(0, min(99999, int(round(altitude)))) if altitude is not None else 0
+        yield 'B%s%s%sA%05d%05d\r\n' % (timestamp.strftime('%H%M%S'), format_coordinate(latitude, 2, 'N', 'S'),
+                                        format_coordinate(longitude, 3, 'E', 'W'), altitude, altitude)
+
+def format_time(timestamp):
+    return timestamp.isoformat(timespec='milliseconds' if timestamp.microsecond else 'seconds') + 'Z'
+
+# GPX file with a track per pilot: tracks are (properties, get_fixes), as
+# for write_geojson
+def write_gpx(tracks):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield '<gpx version="1.1" creator="paractf" xmlns="%s">\n' % GPX_NAMESPACE
+    for properties, get_fixes in tracks:
+        yield '<trk><name>%s</name><trkseg>\n' % escape(properties['name'])
+        for timestamp, latitude, longitude, altitude in get_fixes():
+            if latitude is None or longitude is None:
+                continue
+            ele = '<ele>%s</ele>' % altitude if altitude is not None else ''
+            yield '<trkpt lat="%s" lon="%s">%s<time>%s</time></trkpt>\n' % (latitude, longitude, ele, format_time(timestamp))
+        yield '</trkseg></trk>\n'
+    yield '</gpx>\n'
+
+# GeoJSON FeatureCollection with a LineString per pilot, the times of its
+# points in the coordTimes property. tracks are (properties, get_fixes),
+# properties at least the name of the pilot: the fixes are read twice, for
+# the coordinates then for the times.
+def write_geojson(tracks):
+    yield '{"type": "FeatureCollection", "features": ['
+    for n, (properties, get_fixes) in enumerate(tracks):
+        yield '%s\n{"type": "Feature", "geometry": {"type": "LineString", "coordinates": [' % (',' if n else '')
+        separator = ''
+        for timestamp, latitude, longitude, altitude in get_fixes():
+            if latitude is None or longitude is None:
+                continue
+            position = [ longitude, latitude, altitude ] if altitude is not None else [ longitude, latitude ]
+            yield separator + json.dumps(position)
+            separator = ','
+        yield ']}, "properties": %s, "coordTimes": [' % json.dumps(properties)[:-1]
+        separator = ''
+        for timestamp, latitude, longitude, altitude in get_fixes():
+            if latitude is None or longitude is None:
+                continue
+            yield '%s"%s"' % (separator, format_time(timestamp))
+            separator = ','
+        yield ']}}'
+    yield '\n]}\n'